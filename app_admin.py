@@ -3,15 +3,25 @@
 Backend for mobile clients
 
 """
+import hashlib
+import re
 from init_app import init_app
 from json_encoder import JSONEncoder
-from flask import json, render_template, request, abort
+from flask import (json, render_template, request, abort, stream_with_context,
+                   g)
 from flask.ext.restful import Resource, Api, reqparse, fields, marshal, marshal_with
 from flask.ext.restful.representations.json import settings as restful_json_output_settings
 from database import init_connection, select_db
-from decorators import check_api_key, crossdomain_dec
+from decorators import check_api_key, crossdomain_dec, conditional
+from pagination import (encode_cursor, decode_cursor, get_limit, next_url,
+                        link_header)
 from mongokit import ObjectId
+from bson.errors import InvalidId
 from images import save_img
+import catalog
+import tree
+import integrity
+import transfer
 
 
 #
@@ -27,6 +37,13 @@ connection = init_connection(app)
 # select DB and authenticate
 db = select_db(app, connection)
 
+# catalog revision for caches below
+revisions = catalog.RevisionCache(
+    db, app.config['CATALOG_REVISION_CHECK_INTERVAL'])
+
+# effective custom properties of products (memoized by catalog revision)
+property_resolver = catalog.PropertyResolver(db, revisions)
+
 # HACK: configuring flask-restful json_output helper function
 restful_json_output_settings['cls'] = JSONEncoder
 api = Api(app, decorators = [crossdomain_dec])
@@ -50,6 +67,15 @@ def to_object_id_list(data):
         return []
     return [ObjectId(i) for i in data if i]
 
+def to_bool(data):
+    """Get boolean from request argument"""
+    
+    if data in (u'1', u'true'):
+        return True
+    if data in (u'0', u'false'):
+        return False
+    raise ValueError("Invalid boolean")
+
 def to_image_data(data):
     """Get image data from request
     
@@ -73,13 +99,47 @@ def to_image_data(data):
     
     return mime, img
 
-def add_custom_properties(product):
-    """Add custom properties to product"""
+def revision_etag(name, get_revision=None):
+    """
+    Return get_etag function for decorators.conditional
+    
+    Resource representation depends only on catalog revision, URL and
+    request arguments. get_revision returns revision the representation
+    is built from if it's cached (it may lag behind DB), revision is read
+    from DB by default. ETag is computed before the view is called, so
+    representation is never older than its ETag. The revision is kept in
+    g.revision, so the view can check its state against the same one.
     
+    """
+    
+    if get_revision is None:
+        get_revision = lambda: catalog.get_revision(db)[0]
+    
+    def get_etag(*args, **kwargs):
+        revision = get_revision()
+        g.revision = revision
+        return hashlib.sha1('{}:{}:{}:{}'.format(
+            name, revision, request.path.encode('utf-8'), request.query_string
+        )).hexdigest()
+    
+    return get_etag
+
+def add_custom_properties(product, obj):
+    """
+    Add effective custom properties of obj (DB document) to marshaled
+    product
+    
+    'properties' get definitions of own and inherited properties, values
+    are added as product fields.
+    
+    """
+    
+    entries = property_resolver.resolve(obj)
+    product['properties'] = [marshal(p, customproperty_fields)
+                             for p in entries]
     # TODO: may override property of object
-    if product['properties']:
-        for p in product['properties']:
-            product[p['name']] = p['value']
+    for prop in entries:
+        product[prop['name']] = prop.get('value')
     
     return product
 
@@ -119,6 +179,66 @@ class DateTimeField(fields.Raw):
         return value.strftime('%s %s'.format(DATE_FORMAT, TIME_FORMAT))
 
 
+def delete_node(delete, id_):
+    """
+    Delete category or product by integrity function, mode is taken from
+    request
+    
+    Returns changed (categories, products), aborts if node isn't found.
+    
+    """
+    
+    mode = request.args.get('mode', integrity.REPARENT)
+    if mode not in integrity.DELETE_MODES:
+        abort(400, "Invalid request")
+    
+    try:
+        changed = delete(db, ObjectId(id_), mode)
+    except InvalidId:
+        abort(404)
+    if changed is None:
+        abort(404)
+    
+    return changed
+
+# parser of move requests
+move_parser = reqparse.RequestParser()
+move_parser.add_argument('parent', type=to_object_id, location = 'json')
+
+def move_node(name, id_):
+    """
+    Move category or product with its subtree under new parent
+    
+    Whole subtree is changed by few bulk updates and catalog revision is
+    bumped once.
+    
+    """
+    
+    collection = db[name]
+    args = move_parser.parse_args()
+    
+    try:
+        node_id = ObjectId(id_)
+    except InvalidId:
+        return 'Not found', 404
+    
+    parent_id = args['parent']
+    if parent_id is not None and \
+            collection.find_one({"_id": parent_id}, ['_id']) is None:
+        return 'Parent not found', 400
+    
+    try:
+        moved = tree.move(collection, node_id, parent_id)
+    except tree.CycleError:
+        return 'Node can\'t be moved under itself', 400
+    if moved is None:
+        return 'Not found', 404
+    
+    catalog.changed(db, **{name: moved})
+    
+    return {"id": node_id, "parent": parent_id, "moved": moved}, 200
+
+
 #
 # Admin interface API
 #
@@ -147,6 +267,18 @@ category_fields = {
     "parent": fields.String,
 }
 
+# DB fields needed for category_fields
+category_projection = [
+    'name',
+    'description',
+    'icon_small',
+    'icon_big',
+    'is_hidden',
+    'order',
+    'items_order',
+    'parent',
+]
+
 # Category Resource
 class CategoryList(Resource):
     """List of categories and new category creation"""
@@ -154,11 +286,12 @@ class CategoryList(Resource):
     def options(self):
         return '', 200, {'Allow': 'GET,POST,OPTIONS'}
     
+    @conditional(revision_etag('categories'))
     @marshal_with(category_fields)
     def get(self):
         """Just return list of categories - all of them"""
         
-        categories = db.categories.Category.find()
+        categories = db.categories.find({}, category_projection)
         return list(categories)
     
     @marshal_with(category_fields)
@@ -185,11 +318,12 @@ class CategoryList(Resource):
         parent = None
         # chech ID for parent
         if 'parent' in args and args['parent'] is not None:
-            parent = db.categories.Category.find_one({"_id": ObjectId(args['parent'])})
+            parent = db.categories.find_one({"_id": ObjectId(args['parent'])}, ['_id'])
         if parent is not None:
             category.parent = parent['_id']
         
         category.save()
+        catalog.changed(db, categories = [category['_id']])
         
         return category, 201
 
@@ -204,7 +338,8 @@ class Category(Resource):
         """Get single category"""
         
         try:
-            category = db.categories.Category.find_one({"_id": ObjectId(id_)})
+            category = db.categories.find_one({"_id": ObjectId(id_)},
+                                              category_projection)
         except:
             # TODO: better exception handling - not catch all
             return 'Not found', 404
@@ -212,9 +347,16 @@ class Category(Resource):
         return category
     
     def delete(self, id_):
-        """Remove and that's all"""
+        """Remove category
+        
+        Subcategories are moved to its parent or, if 'mode' argument is
+        'subtree', removed too. Removed categories are removed from
+        products.
+        
+        """
         
-        db.categories.remove({'_id': ObjectId(id_)})
+        changed = delete_node(integrity.delete_categories, id_)
+        catalog.changed(db, categories = changed[0], products = changed[1])
         return '', 204
     
     @marshal_with(category_fields)
@@ -244,7 +386,7 @@ class Category(Resource):
         if 'parent' in args:
             parent = None
             if args['parent'] is not None:
-                parent = db.categories.Category.find_one({"_id": ObjectId(args['parent'])})
+                parent = db.categories.find_one({"_id": ObjectId(args['parent'])}, ['_id'])
             if parent is not None:
                 category.parent = parent['_id']
 
@@ -281,13 +423,113 @@ class Category(Resource):
         elif args['icon_small'] is not None and not args['icon_small']:
             category.icon_small = u''
         
-        category.save()
+        try:
+            category.save()
+        except tree.CycleError:
+            abort(400, "Category can't be moved under itself")
+        catalog.changed(db, categories = [category['_id']])
         
         return category, 201
 
+# category tree for navigation (rebuilt on catalog change)
+category_tree = tree.TreeIndex(db.categories, revisions, category_projection)
+
+# category fields with depth in subtree
+category_subtree_fields = dict(category_fields, depth = fields.Integer)
+
+# category fields in breadcrumbs
+category_breadcrumb_fields = {
+    "id": fields.String(attribute='_id'),
+    "name": fields.String,
+}
+
+def tree_revision():
+    """Revision of category tree (for revision_etag)"""
+    
+    return category_tree.get().revision
+
+def get_tree_node(id_):
+    """Return (tree of current revision, category ObjectId), abort if not found"""
+    
+    current = category_tree.get()
+    try:
+        node_id = ObjectId(id_)
+    except InvalidId:
+        abort(404)
+    if node_id not in current:
+        abort(404)
+    
+    return current, node_id
+
+class CategorySubtree(Resource):
+    """Category with descendants"""
+    
+    def options(self, id_):
+        return '', 200, {'Allow': 'GET,OPTIONS'}
+    
+    @conditional(revision_etag('category-subtree', tree_revision))
+    def get(self, id_):
+        """Return category and its descendants
+        
+        Depth first, children ordered by 'order'. Every item has 'depth'
+        relative to the category. Arguments:
+        'depth' - max depth (1 for children only),
+        'visible' - skip hidden categories (with their descendants).
+        
+        """
+        
+        current, node_id = get_tree_node(id_)
+        
+        max_depth = request.args.get('depth')
+        if max_depth is not None:
+            try:
+                max_depth = int(max_depth)
+            except ValueError:
+                abort(400, "Invalid request")
+        visible = request.args.get('visible') in ('1', 'true')
+        
+        categories = []
+        for i, depth in current.iter_subtree(node_id, max_depth, visible):
+            category = dict(current.nodes[i], depth = depth)
+            categories.append(marshal(category, category_subtree_fields))
+        
+        return categories
+
+class CategoryBreadcrumbs(Resource):
+    """Path from root category"""
+    
+    def options(self, id_):
+        return '', 200, {'Allow': 'GET,OPTIONS'}
+    
+    @conditional(revision_etag('category-breadcrumbs', tree_revision))
+    def get(self, id_):
+        """Return categories from root to this one (inclusive)"""
+        
+        current, node_id = get_tree_node(id_)
+        
+        return [
+            marshal(current.nodes[i], category_breadcrumb_fields)
+            for i in current.get_path(node_id)
+        ]
+
+class CategoryMove(Resource):
+    """Move category with subcategories"""
+    
+    def options(self, id_):
+        return '', 200, {'Allow': 'POST,OPTIONS'}
+    
+    def post(self, id_):
+        """Move category under 'parent' (or to top if it's null)"""
+        
+        return move_node('categories', id_)
+
 # register Category Resource
 api.add_resource(CategoryList, '/db/categories')
 api.add_resource(Category, '/db/categories/<string:id_>')
+api.add_resource(CategoryMove, '/db/categories/<string:id_>/move')
+api.add_resource(CategorySubtree, '/db/categories/<string:id_>/subtree')
+api.add_resource(CategoryBreadcrumbs,
+                 '/db/categories/<string:id_>/breadcrumbs')
 
 
 # product data parser
@@ -326,6 +568,101 @@ product_fields = {
     "properties": fields.List(fields.Nested(customproperty_fields)),
 }
 
+# DB fields needed for product_fields
+product_projection = [
+    'name',
+    'description',
+    'price',
+    'icon_small',
+    'icon_big',
+    'categories',
+    'is_hidden',
+    'parent',
+    'properties',
+    'ancestors',
+]
+
+# product list filters, sort and fields
+product_list_parser = reqparse.RequestParser()
+product_list_parser.add_argument('category', type=to_object_id, location = 'args')
+product_list_parser.add_argument('is_hidden', type=to_bool, location = 'args')
+product_list_parser.add_argument('is_template', type=to_bool, default=False, location = 'args')
+product_list_parser.add_argument('name', type=unicode, location = 'args')
+product_list_parser.add_argument('price_min', type=float, location = 'args')
+product_list_parser.add_argument('price_max', type=float, location = 'args')
+product_list_parser.add_argument('sort', type=unicode, default=u'id', location = 'args')
+product_list_parser.add_argument('fields', type=unicode, location = 'args')
+
+# sort argument: DB field (ties are ordered by _id)
+product_sort_fields = {
+    "id": '_id',
+    "name": 'name',
+    "price": 'price',
+}
+
+def get_product_list_query(args):
+    """Build products query from product_list_parser args"""
+    
+    query = {"is_template": args['is_template']}
+    if args['category'] is not None:
+        query['categories'] = args['category']
+    if args['is_hidden'] is not None:
+        query['is_hidden'] = args['is_hidden']
+    if args['name']:
+        # anchored prefix uses index
+        query['name'] = {'$regex': u'^' + re.escape(args['name'])}
+    price = {}
+    if args['price_min'] is not None:
+        price['$gte'] = args['price_min']
+    if args['price_max'] is not None:
+        price['$lte'] = args['price_max']
+    if price:
+        query['price'] = price
+    
+    return query
+
+def get_product_list_fields(args):
+    """Return (marshal fields, DB projection) for 'fields' argument"""
+    
+    if not args['fields']:
+        return product_fields, product_projection
+    
+    names = set(args['fields'].split(u','))
+    names.add(u'id')
+    if not names.issubset(product_fields):
+        abort(400, "Invalid request")
+    
+    marshal_fields = dict((k, product_fields[k]) for k in names)
+    projection = [k for k in names if k != u'id']
+    if u'properties' in names:
+        projection.append('ancestors')
+    
+    return marshal_fields, projection
+
+def get_keyset_query(sort_field, direction, last_value, last_id):
+    """
+    Query for documents after last (value, _id) in sort order
+    
+    Null (or missing) values are sorted before all others, comparison
+    operators don't match them, so they are handled explicitly.
+    
+    """
+    
+    op = '$gt' if direction == 1 else '$lt'
+    if sort_field == '_id':
+        return {'_id': {op: last_id}}
+    
+    same = {sort_field: last_value, '_id': {op: last_id}}
+    if last_value is None:
+        if direction == 1:
+            return {'$or': [{sort_field: {'$ne': None}}, same]}
+        return same
+    
+    after = [{sort_field: {op: last_value}}, same]
+    if direction == -1:
+        after.append({sort_field: None})
+    return {'$or': after}
+
 # Product Resource
 class ProductList(Resource):
     """List of products and new product creation"""
@@ -334,22 +671,97 @@ class ProductList(Resource):
         return '', 200, {'Allow': 'GET,POST,OPTIONS'}
     
     #@marshal_with(product_fields)
+    @conditional(revision_etag('products', lambda: revisions.get()[0]))
     def get(self):
         """Return products list
         
-        Plane list without templates.
+        Plane list without templates. Custom properties are inherited from
+        ancestors (see catalog.PropertyResolver) and returned if all
+        fields or 'properties' are requested.
         
-        TODO: Custom fields are inherited from parent
+        Filters (see product_list_parser): 'category', 'is_hidden',
+        'is_template', 'name' (prefix), 'price_min', 'price_max'.
+        'sort' is id, name or price ('-' prefix for descending order),
+        'fields' is comma separated list of returned fields.
+        
+        If 'limit' argument is passed list is returned by pages (see
+        pagination). All pages belong to the same catalog revision:
+        if catalog is changed while client is loading pages 409 is returned
+        and client should start over.
         
         """
         
-        products = db.products.Product.find({"is_template": False})
+        args = product_list_parser.parse_args()
+        query = get_product_list_query(args)
+        marshal_fields, projection = get_product_list_fields(args)
+        headers = {}
+        
+        sort = args['sort']
+        direction = 1
+        if sort.startswith(u'-'):
+            sort, direction = sort[1:], -1
+        if sort not in product_sort_fields:
+            abort(400, "Invalid request")
+        sort_field = product_sort_fields[sort]
+        sort_spec = [(sort_field, direction)]
+        if sort_field != '_id':
+            sort_spec.append(('_id', direction))
+            if sort_field not in projection:
+                projection = projection + [sort_field]
+        
+        limit = get_limit()
+        if limit is None:
+            products = db.products.find(query, projection).sort(sort_spec)
+        else:
+            # the same revision as ETag (revisions cache may be updated
+            # while the request is processed)
+            revision = getattr(g, 'revision', None)
+            if revision is None:
+                revision = revisions.get()[0]
+            
+            cursor = request.args.get('cursor')
+            if cursor:
+                try:
+                    cursor_revision, cursor_sort, last_value, last_id = \
+                        decode_cursor(cursor)
+                    last_id = ObjectId(last_id)
+                except (ValueError, TypeError, InvalidId):
+                    return 'Invalid cursor', 400
+                if cursor_sort != args['sort']:
+                    return 'Invalid cursor', 400
+                if cursor_revision != revision:
+                    return 'Catalog is changed', 409
+                
+                after = get_keyset_query(sort_field, direction,
+                                         last_value, last_id)
+                query = {'$and': [query, after]}
+            
+            # one more to find out if there is next page
+            products = list(
+                db.products.find(query, projection)
+                .sort(sort_spec)
+                .limit(limit + 1)
+            )
+            if len(products) > limit:
+                products = products[:limit]
+                last = products[-1]
+                cursor = encode_cursor(
+                    revision, args['sort'],
+                    None if sort_field == '_id' else last.get(sort_field),
+                    unicode(last['_id']),
+                )
+                headers['Link'] = link_header(next_url(cursor))
         
         # marshal and transform custom properties
-        products_marshaled = marshal(list(products), product_fields)
-        products_marshaled = [add_custom_properties(p) for p in products_marshaled]
+        products = list(products)
+        products_marshaled = [marshal(p, marshal_fields) for p in products]
+        if 'properties' in marshal_fields:
+            products_marshaled = [
+                add_custom_properties(marshaled, p)
+                for marshaled, p in zip(products_marshaled, products)
+            ]
         
-        return products_marshaled
+        return products_marshaled, 200, headers
     
     #@marshal_with(product_fields)
     def post(self):
@@ -367,11 +779,19 @@ class ProductList(Resource):
         product.price = args['price']
         product.is_hidden = args['is_hidden']
         
+        parent = None
+        # chech ID for parent
+        if 'parent' in args and args['parent'] is not None:
+            parent = db.products.find_one({"_id": ObjectId(args['parent'])}, ['_id'])
+        if parent is not None:
+            product.parent = parent['_id']
+        
         product.save()
+        catalog.changed(db, products = [product['_id']])
         
         # marshal and transform custom properties
         product_marshaled = marshal(product, product_fields)
-        product_marshaled = add_custom_properties(product_marshaled)
+        product_marshaled = add_custom_properties(product_marshaled, product)
         
         return product_marshaled, 201
 
@@ -391,21 +811,29 @@ class Product(Resource):
         """Get single product"""
         
         try:
-            product = db.products.Product.find_one({"_id": ObjectId(id_)})
+            product = db.products.find_one({"_id": ObjectId(id_)},
+                                           product_projection)
         except:
             # TODO: better exception handling - not catch all
             return 'Not found', 404
         
         # marshal and transform custom properties
         product_marshaled = marshal(product, product_fields)
-        product_marshaled = add_custom_properties(product_marshaled)
+        product_marshaled = add_custom_properties(product_marshaled, product)
         
         return product_marshaled
     
     def delete(self, id_):
-        """Remove and that's all"""
+        """Remove product
+        
+        Children are moved to its parent or, if 'mode' argument is
+        'subtree', removed too. Removed products are removed from
+        categories.
         
-        db.products.remove({'_id': ObjectId(id_)})
+        """
+        
+        changed = delete_node(integrity.delete_products, id_)
+        catalog.changed(db, categories = changed[0], products = changed[1])
         return '', 204
     
     #@marshal_with(product_fields)
@@ -429,18 +857,41 @@ class Product(Resource):
         product.price = args['price']
         product.is_hidden = args['is_hidden']
         
-        # check categories
-        categories = []
-        for c in args['categories']:
-            cat = db.categories.Category.find_one({"_id": ObjectId(c)})
-            if cat is None:
-                continue
-            categories.append(cat['_id'])
-            # update items ordering in category
-            if product['_id'] not in cat['items_order']:
-                cat['items_order'].append(product['_id'])
-                cat.save()
-        product.categories = categories
+        # handle parent change, parent isn't changed if it's not passed
+        if 'parent' in (request.json or {}):
+            parent = None
+            if args['parent'] is not None:
+                parent = db.products.find_one({"_id": ObjectId(args['parent'])}, ['_id'])
+            if parent is not None:
+                product.parent = parent['_id']
+
+            # move to top
+            if not args['parent']:
+                product.parent = None
+        
+        # check categories, ordering in categories is updated after save
+        assigned_categories = []
+        added_categories = []
+        removed_categories = []
+        if 'categories' in (request.json or {}):
+            try:
+                requested = [ObjectId(c) for c in args['categories'] or []]
+            except (InvalidId, TypeError):
+                abort(400, "Invalid request")
+            existing = set(
+                cat['_id'] for cat in
+                db.categories.find({"_id": {"$in": requested}}, ['_id'])
+            )
+            categories = []
+            for c in requested:
+                if c in existing and c not in categories:
+                    categories.append(c)
+            
+            old_categories = product.categories or []
+            added_categories = [c for c in categories if c not in old_categories]
+            removed_categories = [c for c in old_categories if c not in categories]
+            product.categories = categories
+            assigned_categories = categories
 
         # TODO: refactor
         # big image
@@ -471,14 +922,122 @@ class Product(Resource):
         if args['icon_small'] is not None and not args['icon_small']:
             product.icon_small  = u''
         
-        product.save()
+        try:
+            product.save()
+        except tree.CycleError:
+            abort(400, "Product can't be moved under itself")
+        
+        # update items ordering in categories (atomic, so concurrent
+        # edits of other products don't get lost)
+        if assigned_categories:
+            db.categories.update(
+                {"_id": {"$in": assigned_categories}},
+                {"$addToSet": {"items_order": product['_id']}},
+                multi = True,
+            )
+        if removed_categories:
+            db.categories.update(
+                {"_id": {"$in": removed_categories}},
+                {"$pull": {"items_order": product['_id']}},
+                multi = True,
+            )
+        
+        catalog.changed(db, categories = added_categories + removed_categories,
+                        products = [product['_id']])
         
         # marshal and transform custom properties
         product_marshaled = marshal(product, product_fields)
-        product_marshaled = add_custom_properties(product_marshaled)
+        product_marshaled = add_custom_properties(product_marshaled, product)
         
         return product_marshaled, 201
 
+class ProductMove(Resource):
+    """Move product with its descendants"""
+    
+    def options(self, id_):
+        return '', 200, {'Allow': 'POST,OPTIONS'}
+    
+    def post(self, id_):
+        """Move product under 'parent' (or to top if it's null)"""
+        
+        return move_node('products', id_)
+
 # register Product Resource
 api.add_resource(ProductList, '/db/products')
 api.add_resource(Product, '/db/products/<string:id_>')
+api.add_resource(ProductMove, '/db/products/<string:id_>/move')
+
+
+#
+# Bulk import and export
+#
+
+def get_transfer_format():
+    """Format from 'format' argument (jsonl by default)"""
+    
+    format_ = request.args.get('format', 'jsonl')
+    if format_ not in transfer.FORMATS:
+        abort(400, "Invalid request")
+    
+    return format_
+
+class Export(Resource):
+    """Streamed export of collection (see transfer)"""
+    
+    name = None
+    
+    def options(self):
+        return '', 200, {'Allow': 'GET,OPTIONS'}
+    
+    def get(self):
+        """Return all documents as JSON Lines or CSV ('format' argument)"""
+        
+        format_ = get_transfer_format()
+        resp = app.response_class(
+            stream_with_context(transfer.iter_export(db, self.name, format_)),
+            mimetype = transfer.MIMETYPES[format_],
+        )
+        resp.headers['Content-Disposition'] = \
+            'attachment; filename={}.{}'.format(self.name, format_)
+        
+        return resp
+
+class Import(Resource):
+    """Streamed import into collection (see transfer)"""
+    
+    name = None
+    
+    def options(self):
+        return '', 200, {'Allow': 'POST,OPTIONS'}
+    
+    def post(self):
+        """Insert documents from request body (JSON Lines or CSV)
+        
+        Body is read line by line and written in batches. Rows which
+        can't be imported are reported with their line numbers.
+        
+        """
+        
+        format_ = get_transfer_format()
+        importer = transfer.Importer(db, self.name,
+                                     app.config['IMPORT_BATCH_SIZE'])
+        report = importer.run(transfer.iter_rows(request.stream, format_))
+        
+        return report, 200
+
+class CategoryExport(Export):
+    name = 'categories'
+
+class CategoryImport(Import):
+    name = 'categories'
+
+class ProductExport(Export):
+    name = 'products'
+
+class ProductImport(Import):
+    name = 'products'
+
+api.add_resource(CategoryExport, '/db/categories/export')
+api.add_resource(CategoryImport, '/db/categories/import')
+api.add_resource(ProductExport, '/db/products/export')
+api.add_resource(ProductImport, '/db/products/import')
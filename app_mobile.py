@@ -3,13 +3,25 @@
 Backend for mobile clients
 
 """
+import os
+import pprint
+import threading
+import uuid
+from datetime import datetime
 from init_app import init_app
-from flask import json, render_template, request, abort
-from flask.ext.mail import Mail, Message
+from flask import json, render_template, request, abort, stream_with_context
+from flask.ext.mail import Mail
 from flask.ext.restful import fields, marshal, marshal_with
 from database import init_connection, select_db
-from decorators import check_api_key, crossdomain_dec
+from decorators import check_api_key, crossdomain_dec, conditional
+from pagination import (encode_cursor, decode_cursor, get_limit, next_url,
+                        link_header)
 from mongokit import ObjectId
+from notifications import Outbox
+from idempotency import IdempotencyStore
+from orders import OrderWriter, OrderWriteError, BufferFull
+from catalog import (Snapshot, PropertyResolver, build_changes, iter_json, select_encoding,
+                     select_mimetype, dump_compact, MSGPACK_MIMETYPE)
 
 
 #
@@ -28,6 +40,42 @@ db = select_db(app, connection)
 # mail
 mail = Mail(app)
 
+# order notifications sent in background
+outbox = Outbox(
+    app, mail, db,
+    workers = app.config['NOTIFICATION_WORKERS'],
+    max_attempts = app.config['NOTIFICATION_MAX_ATTEMPTS'],
+    retry_delay = app.config['NOTIFICATION_RETRY_DELAY'],
+    batch_size = app.config['NOTIFICATION_BATCH_SIZE'],
+    max_idle = app.config['NOTIFICATION_SMTP_MAX_IDLE'],
+)
+
+# orders written in background
+order_writer = OrderWriter(
+    app, db,
+    max_size = app.config['ORDER_BUFFER_SIZE'],
+    batch_size = app.config['ORDER_BATCH_SIZE'],
+    flush_interval = app.config['ORDER_FLUSH_INTERVAL'],
+    acknowledged = app.config['ORDER_WRITE_ACKNOWLEDGED'],
+)
+
+# process which started background threads (see start_workers)
+workers_pid = None
+workers_lock = threading.Lock()
+
+# responses to retried orders
+idempotency = IdempotencyStore(
+    db,
+    cache_size = app.config['IDEMPOTENCY_CACHE_SIZE'],
+    lock_timeout = app.config['IDEMPOTENCY_LOCK_TIMEOUT'],
+)
+
+# catalog served by /db, rebuilt on changes
+snapshot = Snapshot(db, app.config['CATALOG_REVISION_CHECK_INTERVAL'])
+
+# effective custom properties of ordered products
+property_resolver = PropertyResolver(db, snapshot.revisions)
+
 
 #
 # Helpers
@@ -35,11 +83,21 @@ mail = Mail(app)
 
 # TODO: refactor. partially overlaps with admin api.
 
+def get_db_etag():
+    """ETag of /db response (None in streaming mode and for pages)"""
+    
+    if app.config['CATALOG_STREAMING'] or 'limit' in request.args:
+        return None
+    
+    return snapshot.get().etag(select_mimetype(request.accept_mimetypes),
+                               select_encoding(request.accept_encodings))
+
 class DateTimeField(fields.Raw):
     """Return formated datetime value"""
     
     def format(self, value):
-        return value.strftime('%s %s'.format(DATE_FORMAT, TIME_FORMAT))
+        return value.strftime('{} {}'.format(app.config['DATE_FORMAT'],
+                                             app.config['TIME_FORMAT']))
 
 # cart item fields
 cartitem_fields = {
@@ -68,6 +126,15 @@ person_fields = {
     "fathersname": fields.String,
 }
 
+# product fields needed for order (custom properties are copied too)
+order_product_projection = [
+    'name',
+    'price',
+    'units',
+    'properties',
+    'ancestors',
+]
+
 # order fields
 order_fields = {
     "id": fields.String(attribute = '_id'),
@@ -84,6 +151,26 @@ order_fields = {
 }
 
 
+@app.before_request
+def start_workers():
+    """
+    Start outbox and order writer once in process serving requests
+    
+    Threads don't survive fork, so they aren't started on import: app may
+    be loaded by master process of preforking server (gunicorn --preload).
+    
+    """
+    
+    global workers_pid
+    
+    if workers_pid == os.getpid():
+        return
+    with workers_lock:
+        if workers_pid != os.getpid():
+            outbox.start()
+            order_writer.start()
+            workers_pid = os.getpid()
+
 #
 # Mobile client API
 #
@@ -95,18 +182,26 @@ def get_db_version():
     """
     Return current db version
     
-    Hash of prepared DB in cache (Redis). If differes from previously saved
-    value on client request for full DB is made
-
-    TODO:
+    Hash of prepared DB (see catalog.Snapshot). If differes from previously
+    saved value on client request for full DB is made.
+    
+    Format as follows (JSON):
+    {
+        "version": "<sha1 of /db response>",
+        "revision": <catalog revision>
+    }
+    
+    Both values are cached in memory, so it's cheap to poll.
     
     """
     
-    return json.jsonify(version = 1)
+    revision, digest = snapshot.get_version()
+    return json.jsonify(version = digest, revision = revision)
 
 @app.route('/db', methods = ['GET', 'OPTIONS'])
 @check_api_key
 @crossdomain_dec
+@conditional(get_db_etag, vary = ['Accept', 'Accept-Encoding'])
 def get_db():
     """
     Return DB in format suitable for client app
@@ -141,99 +236,169 @@ def get_db():
             ...
         }
     }
+    
+    If client accepts application/x-msgpack better than JSON compact
+    binary format is returned (see catalog.dump_compact).
+    
+    Serialised catalog is cached in memory (see catalog.Snapshot) along
+    with its compressed variants. Best one for Accept and Accept-Encoding
+    is returned. ETag of uncompressed JSON is the same hash as in
+    /db_version, so If-None-Match request gets 304 Not Modified without
+    body.
+    
+    If CATALOG_STREAMING is set catalog is encoded straight from DB
+    cursors on every request instead (not cached, compressed or tagged).
+    
+    If 'limit' argument is passed catalog is returned by pages (see
+    pagination) with "revision" and "next" (URL or null) keys. All pages
+    are cut from the same revision. If catalog is changed while client
+    is loading pages 409 is returned and client should start over.
         
     """
     
-    def _adapt_category(obj):
-       
-        return (
-            unicode(obj['_id']),
-            {
-                "id": obj['_id'],
-                "parent": obj['parent'],
-                "label": obj['name'],
-                "description": obj['description'],
-                "icon_small": obj['icon_small'],
-                "icon_big": obj['icon_big'],
-                "order": obj['order'],
-                "items_order": obj['items_order'] if 'items_order' in obj else [],
-            },
-        )
-        
-    def _adapt_product(obj):
-
-        props = {
-            "id": obj['_id'],
-            "categories": obj["categories"],
-            "label": obj['name'],
-            "description": obj['description'],
-            "price": obj['price'],
-            "units": obj['units'],
-            "icon_small": obj['icon_small'],
-            "icon_big": obj['icon_big'],
-            "parent": obj['parent'],
-        }
-        
-        # TODO: may overwrite product property
-        for custom_prop in obj['properties']:
-            props[custom_prop['name']] = custom_prop['value']
-        
-        return (
-            unicode(obj['_id']),
-            props,
-        )
-
-    categories = list(db.categories.Category.find({
-        "is_hidden": False
-    }))
-    products = list(db.products.Product.find({
-        "is_template": False,
-        "is_hidden": False,
-        "categories": {
-            "$ne": []
+    limit = get_limit()
+    if limit is not None:
+        return get_db_page(limit)
+    
+    if app.config['CATALOG_STREAMING']:
+        return app.response_class(stream_with_context(iter_json(db)),
+                                  mimetype = 'application/json')
+    
+    current = snapshot.get()
+    mimetype = select_mimetype(request.accept_mimetypes)
+    encoding = select_encoding(request.accept_encodings)
+    
+    resp = app.response_class(current.variants[mimetype, encoding],
+                              mimetype = mimetype)
+    if encoding != 'identity':
+        resp.headers['Content-Encoding'] = encoding
+    resp.vary.update(['Accept', 'Accept-Encoding'])
+    
+    return resp
+
+def get_db_page(limit):
+    """Return page of /db"""
+    
+    current = snapshot.get()
+    
+    after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            revision, collection, id_ = decode_cursor(cursor)
+        except (ValueError, TypeError):
+            abort(400, "Invalid request")
+        if revision != current.revision:
+            abort(409, "Catalog is changed")
+        after = collection, id_
+    
+    data, last = current.get_page(after, limit)
+    data['next'] = None
+    if last is not None:
+        data['next'] = next_url(encode_cursor(current.revision, *last))
+    
+    if select_mimetype(request.accept_mimetypes) == MSGPACK_MIMETYPE:
+        resp = app.response_class(dump_compact(data),
+                                  mimetype = MSGPACK_MIMETYPE)
+    else:
+        resp = json.jsonify(**data)
+    resp.vary.add('Accept')
+    if data['next']:
+        resp.headers['Link'] = link_header(data['next'])
+    
+    return resp
+
+@app.route('/db/changes', methods = ['GET', 'OPTIONS'])
+@check_api_key
+@crossdomain_dec
+def get_db_changes():
+    """
+    Return categories and dishes changed since revision
+    
+    Revision is passed in 'since' argument (see /db_version).
+    
+    Format is the same as of /db plus:
+    {
+        "revision": <catalog revision>,
+        "full": false,
+        "deleted": {
+            "categories": ["<id>", ...],
+            "dishes": ["<id>", ...]
         },
-    }))
-        
-    db_data = {
-        "collections": [
-            "categories",
-            "dishes",
-        ],
-        "categories": dict(map(_adapt_category, categories)),
-        "dishes": dict(map(_adapt_product, products)),
+        ...
     }
     
-    return json.jsonify(**db_data)
+    Hidden items are listed in "deleted" too. If change log doesn't
+    cover requested revision full DB is returned with "full": true.
+    
+    Compact binary format is negotiated the same way as for /db.
+    
+    """
+    
+    try:
+        since = int(request.args.get('since', ''))
+    except ValueError:
+        abort(400, "Invalid request")
+    
+    data = build_changes(db, since)
+    if data is None:
+        current = snapshot.get()
+        data = dict(current.data, revision = current.revision, full = True)
+    else:
+        data['full'] = False
+    
+    if select_mimetype(request.accept_mimetypes) == MSGPACK_MIMETYPE:
+        resp = app.response_class(dump_compact(data),
+                                  mimetype = MSGPACK_MIMETYPE)
+    else:
+        resp = json.jsonify(**data)
+    resp.vary.add('Accept')
+    
+    return resp
 
 @app.route('/order', methods = ['POST', 'OPTIONS'])
 @check_api_key
 @crossdomain_dec
+@idempotency.idempotent('order', form_field = 'order_id')
 def post_order():
     """
     Post order
     
     Create DB entry and notify restaurant staff via email letter.
+    Both are written in background. If too many orders are waiting to be
+    written 503 is returned.
 
     Order freezes values (prices especially) for products in itself.
     
+    Client should pass unique key in Idempotency-Key header or 'order_id'
+    field. Retries with the same key get response of the first request
+    (409 while it's processed), so order isn't created (emailed) twice.
+    
     """
        
     cart = json.loads(request.form.get('cart', '[]'))
     address = json.loads(request.form.get('address', '{}'))
     phones = json.loads(request.form.get('phones', '[]'))
     total = 0.0
+    
+    # all cart products by one query
+    products = db.products.Product.find(
+        {u"_id": {"$in": [ObjectId(p['id']) for p in cart]}},
+        order_product_projection,
+    )
+    products = dict((prod['_id'], prod) for prod in products)
+    
     for p in cart:
-        prod = db.products.Product.find_one({u"_id": ObjectId(p['id'])})
+        prod = products.get(ObjectId(p['id']))
         if prod is None:
             continue
         prod['total'] = prod['price'] * p['count']
         total += float(prod['total'])
 
-        for custom_opt in prod['properties']:
-            prod[custom_opt['name']] = custom_opt['value']
+        custom_properties = dict(prod.get_properties(property_resolver))
         p.update(prod)
-        # add custom properties
-        p['custom_properties'] = prod.get_properties()
+        p.update(custom_properties)
+        p['custom_properties'] = custom_properties
     
     # form fields
     person = {
@@ -271,36 +436,9 @@ def post_order():
     #    # may be comma separated list
     #    emails_to = [e.strip() for e in settings['order_email_to'].split(',') if e.strip()]
 
-    # send message
-    # log errors
-    if emails_to:
-        try:
-            msg = Message(
-                u'[FOOD] new order',
-                sender = email_from,
-                recipients = emails_to
-            )
-
-            order_text = render_template('new_order_email.txt',
-                person = person,
-                phones = phones,
-                cart = cart,
-                total = total,
-                order_comments = order_comments,
-                address = address,
-                secret = secret_key,
-                #settings = settings
-            )
-
-            msg.body = order_text
-            mail.send(msg)
-        except Exception as e:
-            app.logger.error(pprint.pformat(e))
-   
-    # create order in DB
-    # REMOVED IN DEMO:
-    #order = db.orders.Order()
-    order = {}
+    # create order in DB (written in background, see orders.OrderWriter)
+    order = db.orders.Order()
+    order['_id'] = ObjectId()
     order['person'] = person
     order['address'] = address
     order['phones'] = phones
@@ -323,10 +461,38 @@ def post_order():
             "custom_properties": i["custom_properties"],
         })
     order['cart'] = order_cart
-   
-    # REMOVED IN DEMO:
-    #order.save()
+    
+    try:
+        order_writer.accept(order)
+    except BufferFull:
+        resp = json.jsonify(message = u"Too many orders, try again later")
+        resp.status_code = 503
+        resp.headers['Retry-After'] = str(
+            max(1, int(app.config['ORDER_FLUSH_INTERVAL'])))
+        return resp
+    except OrderWriteError as e:
+        app.logger.error(pprint.pformat(e))
+        abort(500)
+
+    # queue message (sent in background, see notifications.Outbox)
+    # log errors
+    if emails_to:
+        try:
+            order_text = render_template('new_order_email.txt',
+                person = person,
+                phones = phones,
+                cart = cart,
+                total = total,
+                order_comments = order_comments,
+                address = address,
+                secret = secret_key,
+                #settings = settings
+            )
 
+            outbox.send(u'[FOOD] new order', email_from, emails_to, order_text)
+        except Exception as e:
+            app.logger.error(pprint.pformat(e))
+   
     data = marshal(dict(order), order_fields)
     return json.jsonify(data)
 
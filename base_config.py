@@ -45,6 +45,19 @@ MONGODB_TESTING = {
     }
 }
 
+# How often (seconds) worker checks catalog revision in DB
+CATALOG_REVISION_CHECK_INTERVAL = 1
+
+# Encode /db straight from DB cursors instead of serving cached snapshot.
+# Keeps memory flat for huge catalogs at the cost of DB scans per request.
+CATALOG_STREAMING = False
+
+# Max page size for paginated lists (see pagination)
+PAGE_LIMIT_MAX = 1000
+
+# Documents inserted by one insert in bulk import (see transfer.Importer)
+IMPORT_BATCH_SIZE = 500
+
 PROJECT_PATH = os.path.dirname(os.path.abspath(__file__))
 STATIC_ROOT = os.path.join(PROJECT_PATH, 'static')
 
@@ -60,6 +73,35 @@ MAIL_DEBUG = True
 #MAIL_USERNAME = 'username'
 #MAIL_PASSWORD = 'password'
 
+# Order notifications (see notifications.Outbox)
+NOTIFICATION_WORKERS = 2
+# attempts to send message before giving up
+NOTIFICATION_MAX_ATTEMPTS = 5
+# delay (seconds) before first retry, doubled for every next one
+NOTIFICATION_RETRY_DELAY = 5
+# max messages sent over one SMTP connection at once
+NOTIFICATION_BATCH_SIZE = 10
+# SMTP connection idle (seconds) longer than that is not reused
+NOTIFICATION_SMTP_MAX_IDLE = 60
+
+# Orders are buffered and written in bulk (see orders.OrderWriter)
+# max orders waiting to be written (503 for new ones)
+ORDER_BUFFER_SIZE = 1000
+# orders written by one insert
+ORDER_BATCH_SIZE = 100
+# max seconds order waits in buffer
+ORDER_FLUSH_INTERVAL = 1
+# wait till order is written before response
+ORDER_WRITE_ACKNOWLEDGED = False
+
+# Retried order requests (see idempotency)
+# seconds stored response is kept in DB
+IDEMPOTENCY_TTL = 24 * 60 * 60
+# responses cached in memory of worker
+IDEMPOTENCY_CACHE_SIZE = 1000
+# seconds request with the same key is considered in progress
+IDEMPOTENCY_LOCK_TIMEOUT = 60
+
 # Bug reports
 BUG_FROM = 'food.bug@example.com'
 BUG_TO = [
@@ -0,0 +1,902 @@
+# coding: utf-8
+"""
+Catalog snapshot for mobile clients
+
+Full catalog (see app_mobile.get_db) is built once and kept in memory of
+the worker until catalog data is changed. Every write path (admin API,
+Product custom properties API) must call changed() after saving.
+
+Changes are counted by catalog revision persisted in 'revisions'
+collection, so workers of other processes notice them too. IDs of changed
+categories and dishes are logged in 'changes' collection for delta sync
+(see build_changes).
+
+"""
+import bisect
+import gzip
+import hashlib
+import threading
+import time
+from contextlib import closing
+from collections import Mapping
+from cStringIO import StringIO
+from itertools import imap
+from flask import json
+from flask.signals import Namespace
+from mongokit import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+# brotli is optional: gzip only if not installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# msgpack is optional: JSON only if not installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+_signals = Namespace()
+
+# sent with DB object as sender and new revision when categories or
+# products are changed
+catalog_changed = _signals.signal('catalog-changed')
+
+# _id of catalog revision document in 'revisions' collection
+REVISION_ID = u'catalog'
+
+# number of latest revisions kept in change log
+CHANGES_KEEP = 1000
+
+# seconds after which revision whose changes aren't logged yet is
+# considered abandoned (see published_revision)
+PENDING_TIMEOUT = 60
+
+
+def get_revision(db):
+    """Return current catalog revision document as (revision, hash)
+    
+    hash is None until some worker builds snapshot of that revision.
+    
+    """
+
+    doc = db.revisions.find_one({'_id': REVISION_ID})
+    if doc is None:
+        return 0, None
+
+    return doc['revision'], doc.get('hash')
+
+def published_revision(doc):
+    """
+    Highest revision of revision document whose changes are fully logged
+
+    Revisions reserved by changed() stay pending until their log entries
+    are inserted. Pending revisions older than PENDING_TIMEOUT seconds
+    (writer died) are ignored.
+
+    """
+
+    revision = doc.get('revision', 0)
+    expired = time.time() - PENDING_TIMEOUT
+    for pending in doc.get('pending') or []:
+        if pending['started'] >= expired:
+            revision = min(revision, pending['revision'] - 1)
+
+    return revision
+
+def reserve_revision(db):
+    """
+    Increment catalog revision and mark it pending
+
+    Returns new revision, it must be published by log_changes().
+
+    """
+
+    while True:
+        doc = db.revisions.find_one({'_id': REVISION_ID}, ['revision'])
+        current = doc['revision'] if doc is not None else 0
+        try:
+            doc = db.revisions.find_and_modify(
+                {'_id': REVISION_ID, 'revision': current},
+                {
+                    '$inc': {'revision': 1},
+                    '$unset': {'hash': 1},
+                    '$push': {'pending': {'revision': current + 1,
+                                          'started': time.time()}},
+                },
+                upsert = doc is None,
+                new = True,
+            )
+        except DuplicateKeyError:
+            # revision document was created concurrently
+            continue
+        if doc is not None:
+            return doc['revision']
+
+def log_changes(db, revision, categories=(), products=()):
+    """Log IDs of changed categories and products, publish revision"""
+
+    entries = [
+        {'revision': revision, 'collection': u'categories', 'id': i}
+        for i in categories
+    ] + [
+        {'revision': revision, 'collection': u'dishes', 'id': i}
+        for i in products
+    ]
+    if entries:
+        db.changes.insert(entries)
+
+    db.revisions.update(
+        {'_id': REVISION_ID},
+        {'$pull': {'pending': {'revision': revision}}},
+    )
+
+def changed(db, categories=(), products=()):
+    """Notify that catalog data in db has been changed
+    
+    Atomically increments catalog revision and logs IDs of changed
+    (created, updated or deleted) categories and products.
+    Returns new revision.
+    
+    """
+
+    revision = reserve_revision(db)
+    log_changes(db, revision, categories, products)
+
+    if revision % CHANGES_KEEP == 0:
+        compact_changes(db, revision - CHANGES_KEEP)
+
+    catalog_changed.send(db, revision = revision)
+
+    return revision
+
+def compact_changes(db, revision):
+    """Remove change log entries up to revision (inclusive)"""
+
+    db.revisions.update(
+        {'_id': REVISION_ID, 'compacted': {'$not': {'$gte': revision}}},
+        {'$set': {'compacted': revision}},
+    )
+    db.changes.remove({'revision': {'$lte': revision}})
+
+
+#
+# Custom properties inheritance
+#
+
+def merge_entry(inherited, own):
+    """
+    Entry of property overridden by own entry
+
+    Own entry of inherited property holds overridden fields only (e.g.
+    name and value), other fields come from inherited entry.
+
+    """
+
+    if inherited is None:
+        return own
+    if own is None:
+        return inherited
+
+    entry = dict(inherited)
+    entry.update(own)
+    return entry
+
+def merge_properties(inherited, own):
+    """
+    Merge own property entries over inherited ones
+
+    inherited is dict of entries by name, new dict is returned.
+
+    """
+
+    merged = dict(inherited)
+    for prop in own or []:
+        merged[prop['name']] = merge_entry(merged.get(prop['name']), prop)
+
+    return merged
+
+def effective_properties(merged):
+    """Entries of merged properties which aren't deleted, in order"""
+
+    return sorted(
+        (prop for prop in merged.itervalues() if not prop.get('is_deleted')),
+        key = lambda prop: (prop.get('order') or 0, prop['name']),
+    )
+
+
+class PropertiesView(Mapping):
+    """
+    Read-only mapping of effective property values by name
+
+    own and inherited are dicts of entries by name, fields of own entries
+    override inherited ones (see merge_entry). Entries aren't copied, so
+    view follows their changes.
+
+    """
+
+    def __init__(self, own, inherited):
+        self.own = own
+        self.inherited = inherited
+
+    def _entry(self, name):
+        entry = merge_entry(self.inherited.get(name), self.own.get(name))
+        if entry is None or entry.get('is_deleted'):
+            return None
+        return entry
+
+    def __getitem__(self, name):
+        entry = self._entry(name)
+        if entry is None:
+            raise KeyError(name)
+        return entry.get('value')
+
+    def __contains__(self, name):
+        return self._entry(name) is not None
+
+    def __iter__(self):
+        for name in self.own:
+            if self._entry(name) is not None:
+                yield name
+        for name, entry in self.inherited.iteritems():
+            if name not in self.own and not entry.get('is_deleted'):
+                yield name
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+
+class PropertyResolver(object):
+    """
+    Effective custom properties of products
+
+    Product inherits properties of its ancestors: fields of entry of lower
+    node override fields of entry of the same name, entry marked
+    is_deleted hides the property. Merged entries of every ancestor (template) node are
+    memoized, so resolving product costs merging its own entries only.
+
+    Memo is dropped when catalog revision is changed if revisions
+    (RevisionCache) is passed, otherwise it lives as long as resolver does
+    (e.g. while one snapshot is built).
+
+    """
+
+    def __init__(self, db, revisions=None):
+        self.collection = db.products
+        self.revisions = revisions
+        self._revision = None
+        # node _id: dict of merged entries by name
+        self._memo = {}
+
+    def _get_memo(self):
+        """Memo of current revision"""
+
+        if self.revisions is not None:
+            revision = self.revisions.get()[0]
+            if revision != self._revision:
+                self._memo = {}
+                self._revision = revision
+
+        return self._memo
+
+    def inherited(self, ancestors):
+        """Merged entries (by name) of ancestors path"""
+
+        if not ancestors:
+            return {}
+
+        memo = self._get_memo()
+        if ancestors[-1] in memo:
+            return memo[ancestors[-1]]
+
+        missing = [i for i in ancestors if i not in memo]
+        nodes = dict(
+            (doc['_id'], doc.get('properties'))
+            for doc in self.collection.find({'_id': {'$in': missing}},
+                                            ['properties'])
+        )
+
+        merged = {}
+        for i in ancestors:
+            if i in memo:
+                merged = memo[i]
+            else:
+                merged = merge_properties(merged, nodes.get(i))
+                memo[i] = merged
+
+        return merged
+
+    def resolve_all(self, product):
+        """Merged entries (by name) of product including deleted ones"""
+
+        return merge_properties(self.inherited(product.get('ancestors')),
+                                product.get('properties'))
+
+    def resolve(self, product):
+        """
+        Effective property entries of product (dict with 'ancestors' and
+        'properties')
+
+        """
+
+        return effective_properties(self.resolve_all(product))
+
+    def values(self, product):
+        """PropertiesView of product (dict with 'ancestors' and 'properties')"""
+
+        own = dict((prop['name'], prop) for prop in product.get('properties') or [])
+        return PropertiesView(own, self.inherited(product.get('ancestors')))
+
+
+def collapse_properties(db):
+    """
+    Reduce own property entries to fields overriding inherited ones
+
+    Entries used to be copied to all descendants as a whole, such copies
+    hide later template changes. Entries equal to inherited ones are
+    removed, others keep name and changed fields only. Effective
+    properties aren't changed. Returns number of updated products.
+
+    """
+
+    resolver = PropertyResolver(db)
+    count = 0
+    products = db.products.find(
+        {'properties': {'$ne': []}, 'ancestors': {'$ne': []}},
+        ['ancestors', 'properties'],
+    )
+    for product in products:
+        inherited = resolver.inherited(product.get('ancestors'))
+        props = []
+        for prop in product.get('properties') or []:
+            base = inherited.get(prop['name'])
+            if base is not None:
+                prop = dict((k, v) for k, v in prop.iteritems()
+                            if k == 'name' or k not in base or base[k] != v)
+                if len(prop) == 1:
+                    continue
+            props.append(prop)
+        if props != product.get('properties'):
+            db.products.update({'_id': product['_id']},
+                {'$set': {'properties': props}})
+            count += 1
+
+    return count
+
+
+#
+# Catalog format
+#
+
+def adapt_category(obj):
+    """Category in format suitable for client app"""
+
+    return (
+        unicode(obj['_id']),
+        {
+            "id": obj['_id'],
+            "parent": obj['parent'],
+            "label": obj['name'],
+            "description": obj['description'],
+            "icon_small": obj['icon_small'],
+            "icon_big": obj['icon_big'],
+            "order": obj['order'],
+            "items_order": obj['items_order'] if 'items_order' in obj else [],
+        },
+    )
+
+def adapt_product(obj, properties):
+    """
+    Product (dish) in format suitable for client app
+
+    properties are effective custom properties (see PropertyResolver).
+
+    """
+
+    props = {
+        "id": obj['_id'],
+        "categories": obj["categories"],
+        "label": obj['name'],
+        "description": obj['description'],
+        "price": obj['price'],
+        "units": obj['units'],
+        "icon_small": obj['icon_small'],
+        "icon_big": obj['icon_big'],
+        "parent": obj['parent'],
+    }
+
+    # TODO: may overwrite product property
+    for custom_prop in properties:
+        props[custom_prop['name']] = custom_prop.get('value')
+
+    return (
+        unicode(obj['_id']),
+        props,
+    )
+
+# filters for categories and dishes sent to client app
+# (indexes are declared in models)
+CATEGORIES_QUERY = {
+    "is_hidden": False,
+}
+DISHES_QUERY = {
+    "is_template": False,
+    "is_hidden": False,
+    "categories": {
+        "$ne": []
+    },
+}
+
+# fields used by adapt_category and adapt_product
+CATEGORY_FIELDS = [
+    'parent',
+    'name',
+    'description',
+    'icon_small',
+    'icon_big',
+    'order',
+    'items_order',
+]
+DISH_FIELDS = [
+    'categories',
+    'name',
+    'description',
+    'price',
+    'units',
+    'icon_small',
+    'icon_big',
+    'parent',
+    'properties',
+    'ancestors',
+]
+
+def adapt_products(db, products):
+    """Adapt products resolving their custom properties"""
+
+    resolver = PropertyResolver(db)
+    for obj in products:
+        yield adapt_product(obj, resolver.resolve(obj))
+
+def build(db):
+    """Query DB and return full catalog (see app_mobile.get_db)"""
+
+    categories = db.categories.find(CATEGORIES_QUERY, CATEGORY_FIELDS)
+    products = db.products.find(DISHES_QUERY, DISH_FIELDS)
+
+    return {
+        "collections": [
+            "categories",
+            "dishes",
+        ],
+        "categories": dict(map(adapt_category, categories)),
+        "dishes": dict(adapt_products(db, products)),
+    }
+
+def iter_json(db, chunk_size=16384):
+    """
+    Generate full catalog JSON (see build) straight from DB cursors
+
+    Documents are adapted and encoded one by one and yielded in chunks of
+    about chunk_size bytes, so memory usage doesn't depend on catalog size.
+    Must be iterated in app context (use flask.stream_with_context).
+
+    """
+
+    categories = db.categories.find(CATEGORIES_QUERY, CATEGORY_FIELDS)
+    products = db.products.find(DISHES_QUERY, DISH_FIELDS)
+    collections = [
+        ("categories", imap(adapt_category, categories)),
+        ("dishes", adapt_products(db, products)),
+    ]
+
+    chunk = [u'{"collections": ["categories", "dishes"]']
+    size = 0
+    for name, items in collections:
+        chunk.append(u', "{}": {{'.format(name))
+        separator = u''
+        for key, value in items:
+            item = u'{}{}: {}'.format(separator, json.dumps(key),
+                                      json.dumps(value))
+            separator = u', '
+            chunk.append(item)
+            size += len(item)
+            if size >= chunk_size:
+                yield u''.join(chunk).encode('utf-8')
+                chunk = []
+                size = 0
+        chunk.append(u'}')
+    chunk.append(u'}')
+
+    yield u''.join(chunk).encode('utf-8')
+
+def build_changes(db, since):
+    """
+    Return categories and dishes changed after revision since
+    
+    Format is the same as of build() plus "revision" and "deleted" keys
+    (see app_mobile.get_db_changes). Deleted and hidden items are listed
+    in "deleted".
+    
+    Returns None if change log doesn't cover requested revision (was
+    compacted or revision is unknown).
+
+    Returned "revision" is the latest one whose changes are fully logged,
+    changes of later (pending) revisions are returned next time.
+    
+    """
+
+    doc = db.revisions.find_one({'_id': REVISION_ID}) or {}
+    if since < doc.get('compacted', 0) or since > doc.get('revision', 0):
+        return None
+    # client may have snapshot of pending revision
+    revision = max(since, published_revision(doc))
+
+    ids = {
+        "categories": set(),
+        "dishes": set(),
+    }
+    changes = db.changes.find(
+        {'revision': {'$gt': since, '$lte': revision}},
+        ['collection', 'id'],
+    )
+    for change in changes:
+        ids[change['collection']].add(change['id'])
+
+    categories = db.categories.find(dict(
+        CATEGORIES_QUERY,
+        _id = {'$in': list(ids['categories'])},
+    ), CATEGORY_FIELDS)
+    products = db.products.find(dict(
+        DISHES_QUERY,
+        _id = {'$in': list(ids['dishes'])},
+    ), DISH_FIELDS)
+
+    data = {
+        "collections": [
+            "categories",
+            "dishes",
+        ],
+        "revision": revision,
+        "categories": dict(map(adapt_category, categories)),
+        "dishes": dict(adapt_products(db, products)),
+    }
+    data['deleted'] = {
+        "categories": [
+            unicode(i) for i in ids['categories']
+            if unicode(i) not in data['categories']
+        ],
+        "dishes": [
+            unicode(i) for i in ids['dishes']
+            if unicode(i) not in data['dishes']
+        ],
+    }
+
+    return data
+
+
+#
+# Compression
+#
+
+def gzip_compress(data):
+    """Compress with best gzip level
+
+    mtime is fixed so result depends only on data.
+
+    """
+
+    buf = StringIO()
+    with closing(gzip.GzipFile(fileobj = buf, mode = 'wb', compresslevel = 9,
+                               mtime = 0)) as f:
+        f.write(data)
+
+    return buf.getvalue()
+
+def brotli_compress(data):
+    """Compress with best brotli quality"""
+
+    return brotli.compress(data, mode = brotli.MODE_TEXT, quality = 11)
+
+# content codings of catalog payload in order of preference
+ENCODINGS = [('gzip', gzip_compress)]
+if brotli is not None:
+    ENCODINGS.insert(0, ('br', brotli_compress))
+
+def select_encoding(accept):
+    """
+    Return best content coding for Accept-Encoding header
+
+    accept is werkzeug Accept object (request.accept_encodings).
+    Returns 'identity' if no coding is acceptable.
+
+    """
+
+    best, best_quality = 'identity', 0
+    for encoding, compress in ENCODINGS:
+        quality = accept[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+
+    return best
+
+
+#
+# Representations
+#
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+
+def select_mimetype(accept):
+    """
+    Return best catalog representation for Accept header
+
+    accept is werkzeug MIMEAccept object (request.accept_mimetypes).
+    JSON is preferred if client accepts both equally.
+
+    """
+
+    if msgpack is not None and accept[MSGPACK_MIMETYPE] > accept[JSON_MIMETYPE]:
+        return MSGPACK_MIMETYPE
+
+    return JSON_MIMETYPE
+
+def dump_json(data):
+    """Return catalog as UTF-8 encoded JSON"""
+
+    payload = json.dumps(data)
+    if isinstance(payload, unicode):
+        payload = payload.encode('utf-8')
+
+    return payload
+
+def dump_compact(data):
+    """
+    Return catalog (result of build or build_changes) in compact format
+
+    It is MessagePack with the same structure as JSON except:
+    - ObjectIds (including keys of "categories" and "dishes") are raw
+      12 bytes binaries
+    - keys of categories and dishes are indexes in "keys" list
+
+    """
+
+    keys = []
+    key_index = {}
+
+    def convert(value):
+        if isinstance(value, ObjectId):
+            return value.binary
+        if isinstance(value, str):
+            return value.decode('utf-8')
+        if isinstance(value, (list, tuple)):
+            return [convert(v) for v in value]
+        if isinstance(value, dict):
+            return dict((convert(k), convert(v)) for k, v in value.iteritems())
+        return value
+
+    def intern(key):
+        if key not in key_index:
+            key_index[key] = len(keys)
+            keys.append(convert(key))
+        return key_index[key]
+
+    def convert_items(items):
+        return dict(
+            (
+                ObjectId(id_).binary,
+                dict((intern(k), convert(v)) for k, v in item.iteritems()),
+            )
+            for id_, item in items.iteritems()
+        )
+
+    packed = {}
+    for name, value in data.iteritems():
+        if name in ("categories", "dishes"):
+            packed[convert(name)] = convert_items(value)
+        elif name == "deleted":
+            packed[u"deleted"] = dict(
+                (convert(k), [ObjectId(i).binary for i in ids])
+                for k, ids in value.iteritems()
+            )
+        else:
+            packed[convert(name)] = convert(value)
+    packed[u"keys"] = keys
+
+    return msgpack.packb(packed, use_bin_type = True)
+
+# serializers of catalog representations
+DUMPS = {
+    JSON_MIMETYPE: dump_json,
+}
+if msgpack is not None:
+    DUMPS[MSGPACK_MIMETYPE] = dump_compact
+
+
+class Build(object):
+    """
+    Catalog built for one revision
+
+    Catalog is serialised once in every representation from DUMPS and
+    every payload is compressed once with every coding from ENCODINGS.
+
+    """
+
+    def __init__(self, revision, data):
+        self.revision = revision
+        # result of build(), must not be modified
+        self.data = data
+        self.payloads = dict(
+            (mimetype, dumps(data)) for mimetype, dumps in DUMPS.iteritems()
+        )
+        # UTF-8 encoded JSON
+        self.payload = self.payloads[JSON_MIMETYPE]
+        self.hash = hashlib.sha1(self.payload).hexdigest()
+
+        # (mimetype, content coding): body
+        self.variants = {}
+        for mimetype, payload in self.payloads.iteritems():
+            self.variants[mimetype, 'identity'] = payload
+            for encoding, compress in ENCODINGS:
+                self.variants[mimetype, encoding] = compress(payload)
+
+        # (collection, id) of all items in pages order, see get_page
+        self._order = None
+
+    def etag(self, mimetype=JSON_MIMETYPE, encoding='identity'):
+        """Return strong ETag of payload in representation and coding"""
+
+        etag = self.hash
+        if mimetype == MSGPACK_MIMETYPE:
+            etag += '-msgpack'
+        if encoding != 'identity':
+            etag += '-' + encoding
+
+        return etag
+
+    def get_page(self, after=None, limit=100):
+        """
+        Return (page, last) where page is part of catalog in format of
+        build() plus "revision"
+
+        Categories go first, then dishes, both ordered by id.
+        after is (collection, id) of the last item of previous page.
+        last is the same for the last item of this page or None if there
+        are no more items.
+
+        """
+
+        order = self._order
+        if order is None:
+            order = sorted(
+                (name, id_)
+                for name in ("categories", "dishes")
+                for id_ in self.data[name]
+            )
+            self._order = order
+
+        start = 0
+        if after is not None:
+            start = bisect.bisect_right(order, tuple(after))
+        keys = order[start:start + limit]
+
+        page = {
+            "collections": self.data["collections"],
+            "revision": self.revision,
+            "categories": {},
+            "dishes": {},
+        }
+        for name, id_ in keys:
+            page[name][id_] = self.data[name][id_]
+
+        last = None
+        if start + limit < len(order):
+            last = keys[-1]
+
+        return page, last
+
+
+class RevisionCache(object):
+    """
+    Latest catalog revision of the worker
+
+    Revision is read from DB at most once per check_interval seconds (and
+    right after catalog_changed signal).
+
+    """
+
+    def __init__(self, db, check_interval=1):
+        self.db = db
+        self.check_interval = check_interval
+        # (revision, hash) from DB and time it was read
+        self._latest = None
+        self._checked = 0
+        catalog_changed.connect(self.invalidate)
+
+    def invalidate(self, sender=None, **extra):
+        """Force revision check on next access"""
+
+        self._checked = 0
+
+    def get(self):
+        """Return latest (revision, hash), cached for check_interval"""
+
+        now = time.time()
+        if self._latest is None or now - self._checked >= self.check_interval:
+            self._latest = get_revision(self.db)
+            self._checked = now
+
+        return self._latest
+
+
+class Snapshot(object):
+    """
+    Serialised catalog cached in memory of the worker
+
+    Catalog revision is checked at most once per check_interval seconds
+    (see RevisionCache). Snapshot is rebuilt on first request after
+    revision change.
+
+    """
+
+    def __init__(self, db, check_interval=1):
+        self.db = db
+        self._lock = threading.Lock()
+        self._build = None
+        self.revisions = RevisionCache(db, check_interval)
+
+    def invalidate(self, sender=None, **extra):
+        """Force revision check on next access"""
+
+        self.revisions.invalidate()
+
+    def _get_latest(self):
+        """Return latest (revision, hash)"""
+
+        return self.revisions.get()
+
+    def get(self):
+        """Return Build of current revision, rebuild if catalog changed"""
+
+        revision = self._get_latest()[0]
+        current = self._build
+        if current is not None and current.revision == revision:
+            return current
+
+        with self._lock:
+            current = self._build
+            if current is not None and current.revision == revision:
+                return current
+
+            current = Build(revision, build(self.db))
+
+            # share hash with other workers (see get_version)
+            self.db.revisions.update(
+                {'_id': REVISION_ID, 'revision': revision, 'hash': None},
+                {'$set': {'hash': current.hash}},
+            )
+
+            self._build = current
+
+        return current
+
+    def get_version(self):
+        """Return (revision, hash) of current catalog
+        
+        Doesn't query catalog collections unless no worker has built
+        snapshot of current revision yet.
+        
+        """
+
+        revision, digest = self._get_latest()
+        current = self._build
+        if current is not None and current.revision == revision:
+            return current.revision, current.hash
+        if digest:
+            return revision, digest
+
+        current = self.get()
+        return current.revision, current.hash
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from mongokit import Connection
-from models import Product, Category
+from models import Product, Category, Order
 
 
 def get_config(app):
@@ -24,7 +24,7 @@ def init_connection(app):
     
     config = get_config(app)
     conn = Connection(**config['connection'])
-    conn.register([Product, Category])
+    conn.register([Product, Category, Order])
     
     return conn
 
@@ -43,4 +43,28 @@ def select_db(app, connection):
     if db_user and db_password:
         db.authenticate(db_user, db_password)
     
+    ensure_indexes(app, db)
+    
     return db
+
+def ensure_indexes(app, db):
+    """
+    Create indexes declared by models
+    
+    Called for selected DB as it needs authentication.
+    
+    """
+    
+    Product.generate_index(db.products)
+    Category.generate_index(db.categories)
+    Order.generate_index(db.orders)
+    
+    # catalog change log (see catalog.build_changes)
+    db.changes.ensure_index('revision')
+    
+    # messages to pick up on start (see notifications.Outbox)
+    db.outbox.ensure_index([('status', 1), ('locked_until', 1)])
+    
+    # stored responses expire (see idempotency.IdempotencyStore)
+    db.idempotency.ensure_index(
+        'created', expireAfterSeconds = app.config['IDEMPOTENCY_TTL'])
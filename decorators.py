@@ -2,6 +2,7 @@
 from datetime import timedelta
 from functools import wraps, update_wrapper
 from flask import make_response, request, abort, current_app
+from werkzeug.http import quote_etag
 
 #
 # View decorators
@@ -24,6 +25,59 @@ def check_api_key(func):
         return func(*args, **kwargs)
     return decorator
 
+def conditional(get_etag, vary=None):
+    """
+    Answer GET request with 304 Not Modified if If-None-Match matches ETag
+    
+    get_etag is called with view arguments and returns strong ETag (not
+    quoted) or None. It must be cheap: view is not called for 304 response.
+    vary is list of request headers ETag depends on (set on 304 response).
+    
+    ETag is set on successful (2xx) responses only, so If-None-Match can
+    match only representation client got before.
+    
+    Decorated function may be a view or a flask-restful resource method.
+    Place it under check_api_key and crossdomain_dec.
+    
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapped_function(*args, **kwargs):
+            if request.method != 'GET':
+                return func(*args, **kwargs)
+
+            etag = get_etag(*args, **kwargs)
+            if etag is None:
+                return func(*args, **kwargs)
+
+            if request.if_none_match.contains(etag):
+                resp = current_app.response_class(status = 304)
+                resp.set_etag(etag)
+                if vary:
+                    resp.vary.update(vary)
+                return resp
+
+            rv = func(*args, **kwargs)
+            if isinstance(rv, current_app.response_class):
+                if 200 <= rv.status_code < 300:
+                    rv.set_etag(etag)
+                return rv
+
+            # flask-restful resource return value: data, code, headers
+            if not isinstance(rv, tuple):
+                rv = (rv,)
+            data = rv[0]
+            code = rv[1] if len(rv) > 1 else 200
+            if not 200 <= code < 300:
+                return rv
+            headers = dict(rv[2]) if len(rv) > 2 else {}
+            headers['ETag'] = quote_etag(etag)
+
+            return data, code, headers
+        return wrapped_function
+    return decorator
+
 def crossdomain(origin=None, methods=None, headers=None,
                 max_age=21600, attach_to_all=True,
                 automatic_options=True):
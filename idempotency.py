@@ -0,0 +1,233 @@
+# coding: utf-8
+"""
+Idempotent POST requests
+
+Client passes unique key in Idempotency-Key header (or in form field).
+Response to the first request with the key is stored, retries get it back
+without running view again. Responses are kept in 'idempotency'
+collection (expired by TTL index, see database.ensure_indexes) and
+in-memory LRU cache of the worker.
+
+"""
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+from bson.binary import Binary
+from flask import request, abort, current_app
+from pymongo.errors import DuplicateKeyError
+
+
+# max length of idempotency key
+KEY_MAX_LENGTH = 200
+
+
+class LRUCache(object):
+    """Thread safe dict with limited size dropping least recently used"""
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last = False)
+
+
+class RequestInProgress(Exception):
+    """Request with the same key is being processed"""
+
+
+class KeyReused(Exception):
+    """Key was used by request with other content"""
+
+
+def request_fingerprint():
+    """Hash of content of current request (form or body)"""
+
+    digest = hashlib.sha1()
+    if request.form:
+        for name, value in sorted(request.form.iteritems(multi = True)):
+            digest.update(u'{}={}\n'.format(name, value).encode('utf-8'))
+    else:
+        digest.update(request.get_data())
+
+    return digest.hexdigest()
+
+
+class IdempotencyStore(object):
+    """
+    Stored responses by request key
+
+    Key is reserved by begin() and either gets response by finish() or is
+    released by cancel(), so failed request may be retried. Reservation
+    older than lock_timeout seconds (worker died) is taken over. Every
+    reservation has owner token, so request whose reservation was taken
+    over can't finish or release it. Request content is identified by
+    fingerprint, the same key with other content is rejected.
+
+    """
+
+    def __init__(self, db, cache_size=1000, lock_timeout=60):
+        self.collection = db.idempotency
+        self.cache = LRUCache(cache_size)
+        self.lock_timeout = lock_timeout
+
+    def begin(self, key, owner, fingerprint=None):
+        """
+        Reserve key for owner (unique token of current request)
+
+        Returns stored response as (status, mimetype, body) if request with
+        the key was processed already, None if key is reserved for current
+        request. Raises RequestInProgress if key is reserved by other
+        request, KeyReused if key was used with other fingerprint.
+
+        """
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            if cached[0] != fingerprint:
+                raise KeyReused(key)
+            return cached[1]
+
+        now = datetime.utcnow()
+        locked_until = now + timedelta(seconds = self.lock_timeout)
+        try:
+            self.collection.insert({
+                '_id': key,
+                'status': u'processing',
+                'owner': owner,
+                'fingerprint': fingerprint,
+                'created': now,
+                'locked_until': locked_until,
+            })
+        except DuplicateKeyError:
+            doc = self.collection.find_one({'_id': key})
+            if doc is None:
+                # expired just now
+                return self.begin(key, owner, fingerprint)
+            if doc.get('fingerprint') != fingerprint:
+                raise KeyReused(key)
+            if doc['status'] != u'done':
+                if doc.get('locked_until', doc['created']) >= now:
+                    raise RequestInProgress(key)
+                # stale reservation, unless other request took it over
+                result = self.collection.update(
+                    {
+                        '_id': key,
+                        'status': u'processing',
+                        'locked_until': doc.get('locked_until'),
+                    },
+                    {'$set': {'locked_until': locked_until, 'owner': owner}},
+                )
+                if not result['n']:
+                    raise RequestInProgress(key)
+                return None
+
+            stored = doc['response']['status'], doc['response']['mimetype'], \
+                str(doc['response']['body'])
+            self.cache.set(key, (fingerprint, stored))
+            return stored
+
+        return None
+
+    def finish(self, key, owner, status, mimetype, body, fingerprint=None):
+        """
+        Store response for key reserved by owner
+
+        Returns False if reservation was taken over by other request.
+
+        """
+
+        result = self.collection.update(
+            {'_id': key, 'owner': owner, 'status': u'processing'},
+            {'$set': {
+                'status': u'done',
+                'response': {
+                    'status': status,
+                    'mimetype': mimetype,
+                    'body': Binary(body),
+                },
+            }},
+        )
+        if not result['n']:
+            return False
+
+        self.cache.set(key, (fingerprint, (status, mimetype, body)))
+        return True
+
+    def cancel(self, key, owner):
+        """Release key reserved by owner"""
+
+        self.collection.remove({'_id': key, 'owner': owner,
+                                'status': u'processing'})
+
+    def idempotent(self, scope, form_field=None):
+        """
+        Make POST view idempotent
+
+        Key is taken from Idempotency-Key header or form_field. Requests
+        without key are processed as usual. Only successful (2xx) responses
+        are stored. Retry with the same key and other content gets 422.
+        Place it under check_api_key and crossdomain_dec.
+
+        """
+
+        def decorator(func):
+            @wraps(func)
+            def wrapped_function(*args, **kwargs):
+                if request.method != 'POST':
+                    return func(*args, **kwargs)
+
+                key = request.headers.get('Idempotency-Key')
+                if not key and form_field:
+                    key = request.form.get(form_field)
+                if not key:
+                    return func(*args, **kwargs)
+                if len(key) > KEY_MAX_LENGTH:
+                    abort(400, "Invalid request")
+                key = u'{}:{}'.format(scope, key)
+                owner = uuid.uuid4().get_hex()
+                fingerprint = request_fingerprint()
+
+                try:
+                    stored = self.begin(key, owner, fingerprint)
+                except RequestInProgress:
+                    abort(409, "Request is in progress")
+                except KeyReused:
+                    abort(422, "Key is used by other request")
+                if stored is not None:
+                    status, mimetype, body = stored
+                    return current_app.response_class(
+                        body, status = status, mimetype = mimetype)
+
+                try:
+                    resp = current_app.make_response(func(*args, **kwargs))
+                except:
+                    self.cancel(key, owner)
+                    raise
+
+                if 200 <= resp.status_code < 300:
+                    self.finish(key, owner, resp.status_code, resp.mimetype,
+                                resp.get_data(), fingerprint)
+                else:
+                    self.cancel(key, owner)
+
+                return resp
+            return wrapped_function
+        return decorator
@@ -0,0 +1,179 @@
+# coding: utf-8
+"""
+References between products and categories
+
+Products refer to categories ('categories'), categories list products
+('items_order'), both refer to parent of the same collection ('parent',
+'ancestors'). Deletes below clean all of them with few multi updates,
+sweep_orphans() finds and repairs references left dangling.
+
+"""
+import catalog
+import tree
+
+
+# delete modes: children are moved to parent of deleted node or deleted
+REPARENT = 'reparent'
+SUBTREE = 'subtree'
+DELETE_MODES = (REPARENT, SUBTREE)
+
+
+def _delete_nodes(collection, node_id, mode):
+    """
+    Delete node (and its subtree in SUBTREE mode)
+
+    Returns (deleted ids, ids of other changed nodes) or None if there is
+    no such node. In REPARENT mode paths of all descendants are changed.
+
+    """
+
+    if mode == SUBTREE:
+        if collection.find_one({'_id': node_id}, ['_id']) is None:
+            return None
+        deleted = [node_id] + tree.descendant_ids(collection, node_id)
+        collection.remove({'_id': {'$in': deleted}})
+        return deleted, []
+
+    descendants = tree.descendant_ids(collection, node_id)
+    if tree.remove_node(collection, node_id) is None:
+        return None
+    return [node_id], descendants
+
+def delete_categories(db, category_id, mode=REPARENT):
+    """
+    Delete category and remove references to deleted categories from
+    products
+
+    Returns (changed category ids, changed product ids) for
+    catalog.changed() or None if there is no such category.
+
+    """
+
+    result = _delete_nodes(db.categories, category_id, mode)
+    if result is None:
+        return None
+    deleted, changed = result
+
+    spec = {'categories': {'$in': deleted}}
+    products = [doc['_id'] for doc in db.products.find(spec, ['_id'])]
+    if products:
+        db.products.update(spec,
+            {'$pull': {'categories': {'$in': deleted}}},
+            multi = True)
+
+    return deleted + changed, products
+
+def _pass_properties(collection, node_id):
+    """
+    Merge own properties of node into entries of its children
+
+    So descendants keep properties inherited through node when it's
+    removed: fields overridden by child stay, other fields come from node.
+
+    """
+
+    node = collection.find_one({'_id': node_id}, ['properties'])
+    if node is None or not node.get('properties'):
+        return
+
+    for child in collection.find({'parent': node_id}, ['properties']):
+        own = child.get('properties') or []
+        props = catalog.merge_properties(
+            dict((prop['name'], prop) for prop in node['properties']), own)
+        names = [prop['name'] for prop in node['properties']]
+        names.extend(prop['name'] for prop in own
+                     if prop['name'] not in names)
+        collection.update({'_id': child['_id']},
+            {'$set': {'properties': [props[name] for name in names]}})
+
+def delete_products(db, product_id, mode=REPARENT):
+    """
+    Delete product and remove deleted products from categories
+
+    In REPARENT mode children get own properties of deleted product (see
+    _pass_properties). Returns (changed category ids, changed product ids)
+    for catalog.changed() or None if there is no such product.
+
+    """
+
+    if mode == REPARENT:
+        _pass_properties(db.products, product_id)
+    result = _delete_nodes(db.products, product_id, mode)
+    if result is None:
+        return None
+    deleted, changed = result
+
+    spec = {'items_order': {'$in': deleted}}
+    categories = [doc['_id'] for doc in db.categories.find(spec, ['_id'])]
+    if categories:
+        db.categories.update(spec,
+            {'$pull': {'items_order': {'$in': deleted}}},
+            multi = True)
+
+    return categories, deleted + changed
+
+def sweep_orphans(db, repair=False):
+    """
+    Find (and repair) dangling references
+
+    Returns report as dict of problem: list of ids of documents with it
+    (number of fixed paths for 'ancestors'). Repair makes:
+    - nodes with missing parent roots,
+    - missing categories and products pulled from 'categories' and
+      'items_order',
+    - 'ancestors' rebuilt where they don't match parents.
+
+    """
+
+    category_ids = set(doc['_id'] for doc in db.categories.find({}, ['_id']))
+    product_ids = set(doc['_id'] for doc in db.products.find({}, ['_id']))
+
+    report = {
+        'categories.parent': [],
+        'categories.items_order': [],
+        'products.parent': [],
+        'products.categories': [],
+    }
+    missing_categories = set()
+    missing_products = set()
+
+    for doc in db.categories.find({}, ['parent', 'items_order']):
+        if doc.get('parent') is not None and doc['parent'] not in category_ids:
+            report['categories.parent'].append(doc['_id'])
+        missing = set(doc.get('items_order') or []) - product_ids
+        if missing:
+            report['categories.items_order'].append(doc['_id'])
+            missing_products.update(missing)
+
+    for doc in db.products.find({}, ['parent', 'categories']):
+        if doc.get('parent') is not None and doc['parent'] not in product_ids:
+            report['products.parent'].append(doc['_id'])
+        missing = set(doc.get('categories') or []) - category_ids
+        if missing:
+            report['products.categories'].append(doc['_id'])
+            missing_categories.update(missing)
+
+    if not repair:
+        return report
+
+    for name in ('categories', 'products'):
+        orphans = report[name + '.parent']
+        if orphans:
+            db[name].update({'_id': {'$in': orphans}},
+                {'$set': {'parent': None}},
+                multi = True)
+    if missing_products:
+        db.categories.update(
+            {'_id': {'$in': report['categories.items_order']}},
+            {'$pull': {'items_order': {'$in': list(missing_products)}}},
+            multi = True)
+    if missing_categories:
+        db.products.update(
+            {'_id': {'$in': report['products.categories']}},
+            {'$pull': {'categories': {'$in': list(missing_categories)}}},
+            multi = True)
+
+    report['categories.ancestors'] = tree.backfill(db.categories)
+    report['products.ancestors'] = tree.backfill(db.products)
+
+    return report
@@ -0,0 +1,108 @@
+# coding: utf-8
+"""
+Management commands
+
+    python manage.py backfill_ancestors
+    python manage.py collapse_properties
+    python manage.py sweep_orphans [--repair]
+    python manage.py export_catalog products products.jsonl
+    python manage.py import_catalog products products.csv --format csv
+
+"""
+from flask.ext.script import Manager
+from init_app import init_app
+from database import init_connection, select_db
+import catalog
+import integrity
+import transfer
+import tree
+
+
+app = init_app()
+manager = Manager(app)
+
+
+def get_db():
+    """Connect to DB of the app"""
+
+    return select_db(app, init_connection(app))
+
+
+@manager.command
+def backfill_ancestors():
+    """Rebuild ancestors paths of products and categories"""
+
+    db = get_db()
+
+    for name in ('categories', 'products'):
+        count = tree.backfill(db[name])
+        print u"{}: {} updated".format(name, count)
+
+
+@manager.command
+def collapse_properties():
+    """Reduce product properties copied from templates (run once on upgrade)"""
+
+    db = get_db()
+    count = catalog.collapse_properties(db)
+    print u"products: {} updated".format(count)
+
+
+@manager.command
+def sweep_orphans(repair=False):
+    """Report (and repair) dangling references between products and categories"""
+
+    db = get_db()
+    report = integrity.sweep_orphans(db, repair)
+
+    for problem, found in sorted(report.iteritems()):
+        if isinstance(found, list):
+            print u"{}: {}".format(problem, len(found))
+            for i in found:
+                print u"    {}".format(i)
+        else:
+            print u"{}: {} fixed".format(problem, found)
+
+    if repair:
+        catalog.changed(
+            db,
+            categories = report['categories.parent'] +
+                report['categories.items_order'],
+            products = report['products.parent'] +
+                report['products.categories'],
+        )
+
+
+# options are added bottom up
+@manager.option('-f', '--format', dest = 'format_', default = 'jsonl',
+                choices = transfer.FORMATS)
+@manager.option('path')
+@manager.option('name', choices = ['categories', 'products'])
+def export_catalog(name, path, format_):
+    """Export categories or products to JSON Lines or CSV file"""
+
+    db = get_db()
+    with open(path, 'wb') as f:
+        for line in transfer.iter_export(db, name, format_):
+            f.write(line)
+
+# options are added bottom up
+@manager.option('-f', '--format', dest = 'format_', default = 'jsonl',
+                choices = transfer.FORMATS)
+@manager.option('path')
+@manager.option('name', choices = ['categories', 'products'])
+def import_catalog(name, path, format_):
+    """Import categories or products from JSON Lines or CSV file"""
+
+    db = get_db()
+    importer = transfer.Importer(db, name, app.config['IMPORT_BATCH_SIZE'])
+    with open(path, 'rb') as f:
+        report = importer.run(transfer.iter_rows(f, format_))
+
+    print u"{} inserted".format(report['inserted'])
+    for error in report['errors']:
+        print u"line {}: {}".format(error['line'], error['error'])
+
+
+if __name__ == '__main__':
+    manager.run()
@@ -4,7 +4,7 @@ from .category import Category
 #from .addition import Addition
 #from .additiongroup import AdditionGroup
 #from .unit import Unit
-#from .order import Order
+from .order import Order
 #from .setting import Setting
 #from .restaurant import Restaurant
 #from .sale import Sale
@@ -0,0 +1,200 @@
+# -*- encoding: utf-8 -*-
+from copy import deepcopy
+from mongokit import Document
+
+
+def get_update(old, new, keys=None):
+    """
+    Update document ($set, $unset, $push, $pull) turning old into new
+
+    Nested dicts are compared by items, so only changed paths are set.
+    Lists of dicts listed in keys (path: key field, e.g. {'properties':
+    'name'}) are compared by items if keys of items are the same, so
+    changes are set by item index (see get_guards). Items appended to list
+    are $push'ed, removed scalar items are $pull'ed, otherwise list is set
+    as a whole.
+
+    """
+
+    update = {}
+    _diff_dict(old, new, u'', update, keys or {})
+    return update
+
+def get_guards(old, update, keys):
+    """
+    Query conditions for update paths going through list items by index
+
+    Key field of every such item must be the same as in old document,
+    otherwise update would change other item (list was changed
+    concurrently).
+
+    """
+
+    guards = {}
+    for paths in update.itervalues():
+        for path in paths:
+            value = old
+            prefix = []
+            for part in path.split(u'.'):
+                if isinstance(value, list):
+                    key = keys.get(u'.'.join(prefix))
+                    value = value[int(part)]
+                    if key is not None:
+                        guards[u'.'.join(prefix + [part, key])] = value[key]
+                elif isinstance(value, dict) and part in value:
+                    value = value[part]
+                else:
+                    break
+                prefix.append(part)
+
+    return guards
+
+def _equal(a, b):
+    """Strict equality (True isn't 1)"""
+
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return set(a) == set(b) and all(_equal(a[k], b[k]) for k in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(_equal(x, y) for x, y in zip(a, b))
+    return a == b
+
+def _diff_dict(old, new, prefix, update, keys):
+    for key, value in new.iteritems():
+        path = prefix + key
+        if key not in old:
+            update.setdefault('$set', {})[path] = value
+        else:
+            _diff_value(old[key], value, path, update, keys)
+
+    for key in old:
+        if key not in new:
+            update.setdefault('$unset', {})[prefix + key] = 1
+
+def _diff_value(old, new, path, update, keys):
+    if isinstance(old, dict) and isinstance(new, dict):
+        _diff_dict(old, new, path + u'.', update, keys)
+    elif isinstance(old, list) and isinstance(new, list):
+        _diff_list(old, new, path, update, keys)
+    elif not _equal(old, new):
+        update.setdefault('$set', {})[path] = new
+
+def _same_keys(old, new, key):
+    """Items of lists are dicts with the same key values"""
+
+    return all(
+        isinstance(a, dict) and isinstance(b, dict) and key in a and
+        key in b and _equal(a[key], b[key])
+        for a, b in zip(old, new)
+    )
+
+def _diff_list(old, new, path, update, keys):
+    if _equal(old, new):
+        return
+
+    key = keys.get(path)
+    if len(new) == len(old) and key is not None and \
+            _same_keys(old, new, key):
+        for i, (a, b) in enumerate(zip(old, new)):
+            _diff_value(a, b, u'{}.{}'.format(path, i), update, keys)
+        return
+
+    if len(new) > len(old) and _equal(new[:len(old)], old):
+        update.setdefault('$push', {})[path] = {'$each': new[len(old):]}
+        return
+
+    if len(new) < len(old):
+        removed = [x for x in old if x not in new]
+        if not any(isinstance(x, (dict, list)) for x in removed) and \
+                _equal([x for x in old if x not in removed], new):
+            update.setdefault('$pull', {})[path] = {'$in': removed}
+            return
+
+    update.setdefault('$set', {})[path] = new
+
+
+class TrackedDocument(Document):
+    """
+    Document saving only changed fields
+
+    State of document is remembered when it's loaded, reloaded or saved.
+    Next save() sends update with changed paths only (see get_update) and
+    validates changed fields only. New documents are saved as usual.
+
+    array_keys are passed to get_update. Update of list items by index
+    is applied only if items at these indexes are still the same (see
+    get_guards), otherwise such lists are set as a whole.
+
+    """
+
+    array_keys = {}
+
+    def __init__(self, *args, **kwargs):
+        super(TrackedDocument, self).__init__(*args, **kwargs)
+        self._mark_saved()
+
+    def _mark_saved(self):
+        """Remember current state as saved one"""
+
+        if '_id' in self:
+            self._saved = deepcopy(dict(self))
+        else:
+            self._saved = None
+
+    def get_update(self):
+        """Update for changes since document was loaded or saved"""
+
+        return get_update(self._saved, self, self.array_keys)
+
+    def reload(self):
+        super(TrackedDocument, self).reload()
+        self._mark_saved()
+
+    def save(self, uuid=False, validate=None, safe=True, *args, **kwargs):
+        """Save changed fields, whole document if it isn't saved yet"""
+
+        if self._saved is None or self._saved.get('_id') != self.get('_id'):
+            super(TrackedDocument, self).save(uuid, validate, safe,
+                                              *args, **kwargs)
+            self._mark_saved()
+            return
+
+        update = self.get_update()
+        if not update:
+            return
+
+        if validate is True or (validate is None and not self.skip_validation):
+            fields = set(
+                path.split('.', 1)[0]
+                for paths in update.itervalues() for path in paths
+            )
+            fields = [f for f in fields if f in self.structure and f in self]
+            self._validate_doc(
+                dict((f, self[f]) for f in fields),
+                dict((f, self.structure[f]) for f in fields),
+            )
+
+        spec = {'_id': self['_id']}
+        guards = get_guards(self._saved, update, self.array_keys)
+        if not guards:
+            self.collection.update(spec, update, safe = safe)
+            self._mark_saved()
+            return
+
+        spec.update(guards)
+        result = self.collection.update(spec, update, safe = True)
+        if not result['n']:
+            # items were moved concurrently, set guarded lists as a whole
+            fields = set(path.split(u'.', 1)[0] for path in guards)
+            update = dict(
+                (op, dict((path, value) for path, value in paths.iteritems()
+                          if path.split(u'.', 1)[0] not in fields))
+                for op, paths in update.iteritems()
+            )
+            update = dict((op, paths) for op, paths in update.iteritems()
+                          if paths)
+            update.setdefault('$set', {}).update(
+                (field, self[field]) for field in fields)
+            self.collection.update({'_id': self['_id']}, update, safe = safe)
+        self._mark_saved()
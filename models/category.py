@@ -1,8 +1,10 @@
 # -*- encoding: utf-8 -*-
-from mongokit import Document, ObjectId
+from mongokit import ObjectId
+import tree
+from .base import TrackedDocument
 
 
-class Category(Document):
+class Category(TrackedDocument):
     """
     Category
     
@@ -21,6 +23,9 @@ class Category(Document):
         
         # reference to Category 
         'parent': ObjectId,
+        
+        # path from root to parent (see tree)
+        'ancestors': [ObjectId],
     }
     
     default_values = {
@@ -29,8 +34,25 @@ class Category(Document):
         "name": u"",
         "description": u"",
         "items_order": [],
+        "ancestors": [],
     }
     
+    indexes = [
+        # catalog for client app (see catalog.CATEGORIES_QUERY)
+        {'fields': 'is_hidden'},
+        {'fields': 'parent'},
+        {'fields': 'ancestors'},
+    ]
+    
     use_dot_notation = True
     # for storing different metadata
     use_schemaless = True
+    
+    def save(self, *args, **kwargs):
+        """Save keeping ancestors path of category and its descendants"""
+        
+        old = tree.update_path(self)
+        super(Category, self).save(*args, **kwargs)
+        if old is not None:
+            tree.move_descendants(self.collection, self._id, old,
+                                  self.ancestors)
@@ -0,0 +1,58 @@
+# -*- encoding: utf-8 -*-
+from datetime import datetime
+from mongokit import Document, ObjectId
+
+
+class Order(Document):
+    """
+    Order from mobile client
+    
+    Freezes product values (prices especially) in cart.
+    Written in bulk by orders.OrderWriter.
+    
+    """
+    
+    structure = {
+        'person': {
+            'firstname': unicode,
+            'lastname': unicode,
+            'fathersname': unicode,
+        },
+        # street, house, building, porch, floor, room, comments
+        # as sent by client
+        'address': dict,
+        'phones': list,
+        'comments': unicode,
+        'datetime': datetime,
+        'status': unicode,
+        'count': int,
+        'total': float,
+        # to change status via Public API
+        'secret': unicode,
+        
+        'cart': [
+            {
+                # reference to Product
+                "id": ObjectId,
+                "name": unicode,
+                "count": int,
+                "total": float,
+                "custom_properties": dict,
+            }
+        ],
+    }
+    
+    default_values = {
+        'status': u'new',
+        'comments': u'',
+        'count': 0,
+        'total': 0.0,
+    }
+    
+    indexes = [
+        {'fields': 'secret'},
+        {'fields': [('datetime', -1)]},
+    ]
+    
+    use_dot_notation = True
+    use_schemaless = True
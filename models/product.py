@@ -1,9 +1,12 @@
 # -*- encoding: utf-8 -*-
 from itertools import chain
-from mongokit import Document, ObjectId, OR
+from mongokit import ObjectId, OR
+import catalog
+import tree
+from .base import TrackedDocument
 
 
-class Product(Document):
+class Product(TrackedDocument):
     """
     Product or product type
     
@@ -75,6 +78,9 @@ class Product(Document):
         
         # reference to Product
         'parent': ObjectId,
+        
+        # path from root to parent (see tree)
+        'ancestors': [ObjectId],
     }
     
     default_values = {
@@ -86,21 +92,170 @@ class Product(Document):
         'icon_big': u'',
     }
     
+    indexes = [
+        # catalog for client app (see catalog.DISHES_QUERY)
+        {
+            'fields': [
+                ('is_template', 1),
+                ('is_hidden', 1),
+                ('categories', 1),
+            ],
+        },
+        {'fields': 'categories'},
+        # admin product list filters and sorting (see
+        # app_admin.ProductList.get)
+        {
+            'fields': [
+                ('is_template', 1),
+                ('name', 1),
+            ],
+        },
+        {
+            'fields': [
+                ('is_template', 1),
+                ('price', 1),
+            ],
+        },
+        {'fields': 'parent'},
+        {'fields': 'ancestors'},
+    ]
+    
     use_dot_notation = True
     use_schemaless = True
     
+    # property entries are updated by index only if names are the same
+    array_keys = {'properties': 'name'}
+    
+    def save(self, *args, **kwargs):
+        """Save keeping ancestors path of product and its descendants"""
+        
+        old = tree.update_path(self)
+        super(Product, self).save(*args, **kwargs)
+        if old is not None:
+            tree.move_descendants(self.collection, self._id, old,
+                                  self.ancestors)
+    
     #
     # Custom properties API
     #
     # this methods save object
     #
+    # Properties are inherited from ancestors (see
+    # catalog.PropertyResolver): 'properties' holds entries added on this
+    # product and overridden fields of inherited ones.
+    #
+    
+    def _catalog_changed(self):
+        """
+        Notify that saved product data has been changed
+        
+        Effective properties of descendants are changed too.
+        
+        """
+        
+        catalog.changed(self.collection.database,
+                        products = [self._id] + self._descendant_ids())
+    
+    def _descendant_ids(self):
+        """Ids of all descendants"""
+        
+        return tree.descendant_ids(self.collection, self._id)
+    
+    def _get_resolver(self, resolver=None):
+        """
+        Passed resolver or resolver of the product
+        
+        Resolver of the product memoizes inherited entries while catalog
+        revision is the same (see catalog.RevisionCache), it's dropped on
+        reload.
+        
+        """
+        
+        if resolver is not None:
+            return resolver
+        
+        resolver = getattr(self, '_resolver', None)
+        if resolver is None:
+            db = self.collection.database
+            resolver = catalog.PropertyResolver(db, catalog.RevisionCache(db))
+            self._resolver = resolver
+        return resolver
+    
+    def _properties_changed(self):
+        """Invalidate index of own entries"""
+        
+        self._properties_version = getattr(self, '_properties_version', 0) + 1
+    
+    def _property_index(self, check=False):
+        """
+        Own entries as (name -> index, name -> entry)
+        
+        Built lazily and rebuilt when properties list is replaced or
+        entries are added or removed (see _properties_changed). Entries
+        replaced or renamed in place are noticed only if check is True.
+        
+        """
+        
+        props = self.get('properties') or []
+        key = (getattr(self, '_properties_version', 0), len(props))
+        cached = getattr(self, '_index_cache', None)
+        if cached is None or cached[0] != key or (check and any(
+                cached[2].get(prop['name']) is not prop for prop in props)):
+            cached = (
+                key,
+                dict((p['name'], i) for i, p in enumerate(props)),
+                dict((p['name'], p) for p in props),
+            )
+            self._index_cache = cached
+        
+        return cached[1], cached[2]
+    
+    def _own_index(self, name):
+        """Index of own entry of property or None"""
+        
+        index, entries = self._property_index()
+        i = index.get(name)
+        if i is None or self.properties[i]['name'] != name:
+            # may be renamed or replaced in place
+            i = self._property_index(check = True)[0].get(name)
+        
+        return i
+    
+    def reload(self):
+        super(Product, self).reload()
+        self._properties_changed()
+        self._resolver = None
+    
+    def _override(self, name):
+        """
+        Index of own entry of property
+        
+        Empty entry (name only) overriding inherited one is added to
+        product if there is no own one, so fields which aren't set on the
+        product keep following ancestors. Returns None if property isn't
+        found.
+        
+        """
+        
+        i = self._own_index(name)
+        if i is not None:
+            return i
+        
+        inherited = self._get_resolver().inherited(self.get('ancestors'))
+        if name not in inherited:
+            return None
+        
+        self.properties.append({"name": name})
+        self._properties_changed()
+        return len(self.properties) - 1
     
     def add_property(self, name, default_value, value, options=None, order=0, 
                      label=None, is_deleted=False):
         """
-        Add custom property to product and all it's descendants
+        Add custom property to product, it's inherited by descendants
         
-        If property already exists it will be recreated.
+        If property already exists it will be recreated. Descendants which
+        override the property keep their entries.
         
         """
         
@@ -121,22 +276,22 @@ class Product(Document):
             "order": order,
             "is_deleted": is_deleted,
         }
-    
-        self.del_property(prop['name'], True)
         
-        self.properties.append(prop)
+        i = self._own_index(prop['name'])
+        if i is None:
+            self.properties.append(prop)
+        else:
+            self.properties[i] = prop
+        self._properties_changed()
         self.save()
-        
-        # find descendants and add
-        descendants = self.collection.Product.find({"parent": self._id})
-        for p in descendants:
-            p.add_property(**prop)
+        self._catalog_changed()
             
     def edit_property(self, name, **kwargs):
         """
         Change attributes of property
         
-        Recursive. Can override current values for all products!!!
+        Inherited property is overridden on this product. Descendants
+        inherit the change unless they override the property.
         
         """
         
@@ -150,91 +305,123 @@ class Product(Document):
             "is_deleted",
         ]
         
-        prop_found = False
-        for i, v in enumerate(self.properties):
-            if v['name'] == name:
-                prop_found = True
-                for pk, pv in kwargs.items():
-                    if pk in prop_fields:
-                        self.properties[i][pk] = pv
-                self.save()
-        
-        if not prop_found:
+        i = self._override(name)
+        if i is None:
             raise Exception(u"Custom property '{}' not found for ObjectId('{}')".format(name, self._id))
         
-        descendants = self.collection.Product.find({"parent": self._id})
-        for p in descendants:
-            p.edit_property(name, **kwargs)
+        for pk, pv in kwargs.items():
+            if pk in prop_fields:
+                self.properties[i][pk] = pv
+        if 'name' in kwargs:
+            self._properties_changed()
+        self.save()
+        self._catalog_changed()
     
     def del_property(self, name, recursively=False):
         """
         Delete custom property
         
-        By default deletes (marks deleted) property of current node (product).
-        If recursively is True than completely deletes property from current
-        node and all it descendants.  
+        By default deletes (marks deleted) property of current node (product)
+        and so for its descendants. Inherited property is overridden by
+        deleted entry.
+        If recursively is True than completely deletes own entries of
+        property from current node and all it descendants.
         
         """
         
         # only set flag on current product
         if not recursively:
-            for i, v in enumerate(self.properties):
-                if v['name'] == name:
-                    self.properties[i]['is_deleted'] = True
-                    self.save()
-                    break
+            i = self._override(name)
+            if i is not None:
+                self.properties[i]['is_deleted'] = True
+                self.save()
+                self._catalog_changed()
             return
         
         # completely delete property
-        for i, v in enumerate(self.properties):
-            if v['name'] == name:
-                del self.properties[i]
-                self.save()
-                break
+        i = self._own_index(name)
+        if i is not None:
+            del self.properties[i]
+            self._properties_changed()
+            self.save()
         
         # only saved products can have descendants
-        if '_id' in self:
-            descendants = self.collection.Product.find({"parent": self._id})
-            for p in descendants:
-                p.del_property(name, True)
-
-    def get_property(self, name):
-        """Get custom property by name"""
+        if '_id' not in self:
+            return
+        
+        owners = [doc['_id'] for doc in self.collection.find(
+            {'ancestors': self._id, 'properties.name': name}, ['_id'])]
+        if owners:
+            result = self.collection.update(
+                {"_id": {"$in": owners}, "properties.name": name},
+                {"$pull": {"properties": {"name": name}}},
+                multi = True)
+            if not result['n']:
+                owners = []
         
-        for p in self.properties:
-            if p['name'] == name:
-                return p['value']
+        if i is not None:
+            # effective property of all descendants is changed
+            self._catalog_changed()
+        elif owners:
+            # descendants of owners inherited their entries
+            changed = set(owners)
+            changed.update(doc['_id'] for doc in self.collection.find(
+                {'ancestors': {'$in': owners}}, ['_id']))
+            catalog.changed(self.collection.database,
+                            products = list(changed))
+
+    def get_property(self, name, resolver=None):
+        """Get effective custom property by name"""
         
-        return None
+        return self.get_properties(resolver).get(name)
 
-    def get_properties(self):
-        """Get custom properties as dict"""
-        props = {}
-        if self['properties']:
-            for p in self['properties']:
-                props[p['name']] = p['value']
-        return props
+    def get_properties(self, resolver=None):
+        """
+        Get effective custom properties as read-only mapping
+        
+        View is cached while own entries and inherited ones (memoized by
+        resolver) are the same.
+        
+        """
+        
+        inherited = self._get_resolver(resolver).inherited(self.get('ancestors'))
+        entries = self._property_index(check = True)[1]
+        
+        view = getattr(self, '_properties_view', None)
+        if view is None or view.own is not entries or \
+                view.inherited is not inherited:
+            view = catalog.PropertiesView(entries, inherited)
+            self._properties_view = view
+        
+        return view
     
     def set_property(self, name, value):
         """
         Set custom property
         
-        Property must be added before or exception will be thrown
+        Property must be added before (to product or its ancestor) or
+        False is returned.
         
         """
-    
-        for i, v in enumerate(self.properties):
-            if v['name'] == name:
-                self.properties[i]['value'] = value
-                self.save()
-                return True
-            
-        return False
+        
+        i = self._override(name)
+        if i is None:
+            return False
+        
+        self.properties[i]['value'] = value
+        self.save()
+        self._catalog_changed()
+        return True
     
     #
     # API for using custom properties as properties;)
     #
     
+    def __setitem__(self, key, value):
+        super(Product, self).__setitem__(key, value)
+        if key == 'properties':
+            self._properties_changed()
+    
     def __setattr__(self, key, value):
         if key.startswith('custom_property'):
             self.set_property(key.replace('custom_property_', ''), value)
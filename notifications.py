@@ -0,0 +1,393 @@
+# coding: utf-8
+"""
+Background email notifications
+
+Messages are stored in 'outbox' collection and sent by pool of worker
+threads, so request handlers don't wait for SMTP server. Failed messages
+are retried with exponential backoff. Messages left in outbox (process
+was stopped or crashed) are picked up by outbox of any running process
+once their lease expires.
+
+SMTP connections are kept open between messages (see SMTPPool) and
+messages queued at the same time are sent over one connection.
+
+"""
+import atexit
+import os
+import smtplib
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from Queue import Queue, Empty
+from flask.ext.mail import Message
+
+
+class SMTPPool(object):
+    """
+    Pool of open SMTP connections (flask-mail Connection objects)
+
+    Connection is checked with NOOP before reuse and is closed if it was
+    idle longer than max_idle seconds (servers drop idle clients anyway).
+
+    """
+
+    def __init__(self, mail, size=2, max_idle=60):
+        self.mail = mail
+        self.size = size
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Return live connection (reused or new)"""
+
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, released = self._idle.pop()
+
+            if time.time() - released < self.max_idle and self._is_alive(conn):
+                return conn
+            self._close(conn)
+
+        conn = self.mail.connect()
+        conn.host = None if self.mail.suppress else conn.configure_host()
+        conn.num_emails = 0
+
+        return conn
+
+    def release(self, conn, broken=False):
+        """Return connection to pool, close it if it's broken"""
+
+        if not broken:
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append((conn, time.time()))
+                    return
+
+        self._close(conn)
+
+    def close(self):
+        """Close all idle connections"""
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for conn, released in idle:
+            self._close(conn)
+
+    def _is_alive(self, conn):
+        """Health check"""
+
+        if conn.host is None:
+            return True
+
+        try:
+            return conn.host.noop()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def _close(self, conn):
+        """Close connection ignoring errors"""
+
+        if conn.host is None:
+            return
+
+        try:
+            conn.host.quit()
+        except (smtplib.SMTPException, socket.error):
+            conn.host.close()
+        conn.host = None
+
+
+class Outbox(object):
+    """
+    Queue of email messages drained by worker threads
+
+    Every queued message is leased to the process for lease seconds, so
+    it's not picked up by other running processes. Messages with expired
+    lease are picked up every scan_interval seconds. Leases of messages
+    the process won't send are released on stop.
+
+    Outbox may be created before the process forks (preloading server),
+    but it must be started in the process which sends messages.
+
+    """
+
+    def __init__(self, app, mail, db, workers=2, max_attempts=5,
+                 retry_delay=5, lease=600, batch_size=10, max_idle=60,
+                 scan_interval=60):
+        self.app = app
+        self.mail = mail
+        self.pool = SMTPPool(mail, workers, max_idle)
+        self.batch_size = batch_size
+        self.collection = db.outbox
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = lease
+        self.scan_interval = scan_interval
+
+        # identifies this process in outbox documents
+        self.owner = uuid.uuid4().get_hex()
+        self._pid = os.getpid()
+        self._queue = Queue()
+        self._threads = []
+        self._timers = {}
+        self._timers_lock = threading.Lock()
+        self._stopped = False
+        self._stop_event = threading.Event()
+        self._scanner = None
+
+    def start(self):
+        """Start workers and enqueue messages left from previous run"""
+
+        if self._pid != os.getpid():
+            # forked after creation, other processes have the same owner
+            self.owner = uuid.uuid4().get_hex()
+            self._pid = os.getpid()
+
+        for i in range(self.workers):
+            thread = threading.Thread(target = self._work,
+                                      name = 'outbox-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        atexit.register(self.stop)
+
+        self._claim_expired()
+
+        self._scanner = threading.Thread(target = self._scan,
+                                         name = 'outbox-scanner')
+        self._scanner.daemon = True
+        self._scanner.start()
+
+    def _claim_expired(self):
+        """Lease and enqueue messages with expired lease"""
+
+        while True:
+            doc = self.collection.find_and_modify(
+                {'status': u'pending', 'locked_until': {'$lt': datetime.now()}},
+                {'$set': self._lock_fields()},
+                new = True,
+            )
+            if doc is None:
+                break
+            self._schedule(doc)
+
+    def _scan(self):
+        """Scanner thread loop"""
+
+        while not self._stop_event.wait(self.scan_interval):
+            try:
+                self._claim_expired()
+            except Exception:
+                self.app.logger.exception("Outbox scanner error")
+
+    def stop(self, timeout=30):
+        """
+        Send queued messages and stop workers
+
+        Messages waiting for retry stay in outbox, their leases are
+        released so other processes pick them up right away. If some
+        worker is still sending after timeout, messages it may send keep
+        their leases.
+
+        """
+
+        if self._stopped:
+            return
+        self._stopped = True
+        self._stop_event.set()
+        if self._scanner is not None:
+            self._scanner.join(timeout)
+
+        with self._timers_lock:
+            released = list(self._timers)
+            for timer in self._timers.values():
+                timer.cancel()
+            self._timers.clear()
+
+        # workers exit after everything queued before is sent
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+        self.pool.close()
+
+        # messages left in queue are not sent if all workers exited
+        if not any(thread.is_alive() for thread in self._threads):
+            while True:
+                try:
+                    doc = self._queue.get_nowait()
+                except Empty:
+                    break
+                if doc is not None:
+                    released.append(doc['_id'])
+
+        if released:
+            self._release(released)
+
+    def _release(self, ids):
+        """Release leases of messages, other processes may send them"""
+
+        self.collection.update(
+            {'_id': {'$in': ids}, 'owner': self.owner, 'status': u'pending'},
+            {'$set': {'locked_until': datetime.now()}},
+            multi = True,
+        )
+
+    def send(self, subject, sender, recipients, body):
+        """Store message in outbox and queue it for sending"""
+
+        doc = {
+            'subject': subject,
+            'sender': sender,
+            'recipients': recipients,
+            'body': body,
+            'status': u'pending',
+            'attempts': 0,
+            'created': datetime.now(),
+            'next_attempt': datetime.now(),
+        }
+        doc.update(self._lock_fields())
+        self.collection.insert(doc)
+        self._queue.put(doc)
+
+        return doc['_id']
+
+    def _lock_fields(self, delay=0):
+        """Fields leasing message to this process"""
+
+        return {
+            'owner': self.owner,
+            'locked_until': datetime.now() + timedelta(
+                seconds = delay + self.lease),
+        }
+
+    def _schedule(self, doc):
+        """Queue message now or when its next attempt is due"""
+
+        delay = (doc['next_attempt'] - datetime.now()).total_seconds()
+        if delay <= 0:
+            self._queue.put(doc)
+            return
+
+        def enqueue():
+            with self._timers_lock:
+                self._timers.pop(doc['_id'], None)
+            self._queue.put(doc)
+
+        timer = threading.Timer(delay, enqueue)
+        timer.daemon = True
+        with self._timers_lock:
+            stopped = self._stopped
+            if not stopped:
+                self._timers[doc['_id']] = timer
+        if stopped:
+            # failed while stopping, it won't be retried by this process
+            self._release([doc['_id']])
+            return
+        timer.start()
+
+    def _work(self):
+        """Worker thread loop"""
+
+        while True:
+            # everything queued at the moment goes over one connection
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+
+            try:
+                self._deliver([doc for doc in batch if doc is not None])
+            except Exception:
+                self.app.logger.exception("Outbox worker error")
+            finally:
+                for doc in batch:
+                    self._queue.task_done()
+
+            if batch[-1] is None:
+                return
+
+    def _deliver(self, docs):
+        """Try to send messages, schedule retry on failure"""
+
+        if not docs:
+            return
+
+        with self.app.app_context():
+            try:
+                conn = self.pool.acquire()
+            except (smtplib.SMTPException, socket.error) as e:
+                for doc in docs:
+                    self._failed(doc, e)
+                return
+
+            for doc in docs:
+                msg = Message(
+                    doc['subject'],
+                    sender = doc['sender'],
+                    recipients = doc['recipients'],
+                    body = doc['body'],
+                )
+
+                try:
+                    conn.send(msg)
+                except (smtplib.SMTPServerDisconnected, socket.error) as e:
+                    # connection is lost, get new one for the rest
+                    self._failed(doc, e)
+                    self.pool.release(conn, broken = True)
+                    try:
+                        conn = self.pool.acquire()
+                    except (smtplib.SMTPException, socket.error) as e:
+                        for rest in docs[docs.index(doc) + 1:]:
+                            self._failed(rest, e)
+                        return
+                    continue
+                except Exception as e:
+                    # message is rejected, connection is fine
+                    self._failed(doc, e)
+                    continue
+
+                self.collection.remove({'_id': doc['_id']})
+
+            self.pool.release(conn)
+
+    def _failed(self, doc, error):
+        """Schedule retry or give up"""
+
+        doc['attempts'] += 1
+        if doc['attempts'] >= self.max_attempts:
+            self.app.logger.error(u"Giving up sending message {}: {!r}".format(
+                doc['_id'], error))
+            self.collection.update({'_id': doc['_id']}, {'$set': {
+                'status': u'failed',
+                'attempts': doc['attempts'],
+                'error': unicode(repr(error)),
+            }})
+            return
+
+        delay = self.retry_delay * 2 ** (doc['attempts'] - 1)
+        self.app.logger.warning(
+            u"Sending message {} failed, retry in {}s: {!r}".format(
+                doc['_id'], delay, error))
+
+        doc['next_attempt'] = datetime.now() + timedelta(seconds = delay)
+        fields = self._lock_fields(delay)
+        fields.update({
+            'attempts': doc['attempts'],
+            'next_attempt': doc['next_attempt'],
+            'error': unicode(repr(error)),
+        })
+        self.collection.update({'_id': doc['_id']}, {'$set': fields})
+
+        self._schedule(doc)
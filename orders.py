@@ -0,0 +1,144 @@
+# coding: utf-8
+"""
+Write-behind persistence of orders
+
+Orders are accepted into bounded in-memory buffer and written to 'orders'
+collection by background thread with bulk inserts, so journaled write is
+paid once per batch instead of once per request.
+
+"""
+import atexit
+import threading
+import time
+from pymongo.errors import PyMongoError, DuplicateKeyError
+
+
+class OrderWriteError(Exception):
+    """Order is not written"""
+
+
+class BufferFull(OrderWriteError):
+    """Buffer can't accept more orders, client should retry later"""
+
+
+class OrderWriter(object):
+    """
+    Bounded buffer of orders flushed with bulk inserts
+
+    Buffer is flushed when it has batch_size orders or every
+    flush_interval seconds. In acknowledged mode accept() returns only
+    after order is written (like fsync), otherwise right away.
+
+    """
+
+    def __init__(self, app, db, max_size=1000, batch_size=100,
+                 flush_interval=1, acknowledged=False, timeout=10):
+        self.app = app
+        self.collection = db.orders
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.acknowledged = acknowledged
+        self.timeout = timeout
+
+        # [doc, event, error] entries
+        self._buffer = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        """Start flushing thread"""
+
+        self._thread = threading.Thread(target = self._run,
+                                        name = 'order-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+        atexit.register(self.stop)
+
+    def stop(self, timeout=30):
+        """Write buffered orders and stop"""
+
+        with self._cond:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._cond.notify()
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def accept(self, order):
+        """
+        Validate order (mongokit document with _id set) and buffer it
+
+        Raises BufferFull if buffer is full, OrderWriteError if order isn't
+        written in acknowledged mode.
+
+        """
+
+        order.validate()
+
+        entry = [dict(order), None, None]
+        if self.acknowledged:
+            entry[1] = threading.Event()
+
+        with self._cond:
+            if self._stopped or len(self._buffer) >= self.max_size:
+                raise BufferFull()
+            self._buffer.append(entry)
+            if len(self._buffer) >= self.batch_size or self.acknowledged:
+                self._cond.notify()
+
+        if not self.acknowledged:
+            return
+
+        if not entry[1].wait(self.timeout):
+            raise OrderWriteError("Order is not written in time")
+        if entry[2] is not None:
+            raise OrderWriteError(entry[2])
+
+    def _run(self):
+        """Flushing thread loop"""
+
+        while True:
+            with self._cond:
+                deadline = time.time() + self.flush_interval
+                while (not self._stopped and
+                       len(self._buffer) < self.batch_size and
+                       not (self._buffer and self.acknowledged)):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:self.batch_size]
+                stopped = self._stopped and not self._buffer
+
+            if batch:
+                self._flush(batch)
+            if stopped:
+                return
+
+    def _flush(self, batch):
+        """Write batch by one insert, one by one if it fails"""
+
+        try:
+            self.collection.insert([entry[0] for entry in batch])
+        except PyMongoError:
+            # some orders may be written already
+            for entry in batch:
+                try:
+                    self.collection.insert(entry[0])
+                except DuplicateKeyError:
+                    pass
+                except PyMongoError as e:
+                    self.app.logger.error(u"Order {} is not written: {!r}".format(
+                        entry[0]['_id'], e))
+                    entry[2] = unicode(repr(e))
+
+        for entry in batch:
+            if entry[1] is not None:
+                entry[1].set()
@@ -0,0 +1,62 @@
+# coding: utf-8
+"""
+Helpers for cursor based pagination
+
+Cursor is opaque for clients (urlsafe base64 of JSON list). It is passed
+in 'cursor' argument, page size in 'limit' argument. Link to the next page
+is returned in Link header.
+
+"""
+import base64
+import binascii
+from flask import json, request, current_app, abort
+from werkzeug.urls import url_encode
+
+
+def encode_cursor(*values):
+    """Make cursor from JSON serializable values"""
+
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+def decode_cursor(cursor):
+    """Return list of cursor values, raise ValueError if cursor is broken"""
+
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, UnicodeError, binascii.Error):
+        raise ValueError("Invalid cursor")
+
+def get_limit():
+    """
+    Get page size from request
+
+    Returns None if 'limit' argument is not passed (no pagination).
+    Aborts with 400 if it's invalid. Page size is trimmed to PAGE_LIMIT_MAX.
+
+    """
+
+    limit = request.args.get('limit')
+    if limit is None:
+        return None
+
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400, "Invalid request")
+    if limit < 1:
+        abort(400, "Invalid request")
+
+    return min(limit, current_app.config['PAGE_LIMIT_MAX'])
+
+def next_url(cursor):
+    """URL of current request with cursor of the next page"""
+
+    args = request.args.copy()
+    args['cursor'] = cursor
+
+    return u'{}?{}'.format(request.base_url, url_encode(args))
+
+def link_header(url):
+    """Link header value for the next page"""
+
+    return u'<{}>; rel="next"'.format(url)
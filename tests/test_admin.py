@@ -0,0 +1,80 @@
+# coding: utf-8
+"""
+Testing admin API
+
+"""
+from flask import json
+from tests import AppTestCase
+import app_admin
+
+
+class TestProductAPI(AppTestCase):
+    """
+    Test product resources
+    
+    """
+    
+    def setUp(self):
+        """Create template with property and its product"""
+        
+        self.mongo_db.products.remove()
+        self.client = app_admin.app.test_client()
+        
+        template = self.mongo_db.products.Product()
+        template.name = u"Pizza"
+        template.is_template = True
+        template.save()
+        template.add_property(u"size", u"30", u"30", options = [u"30", u"40"],
+                              label = u"Size, cm")
+        self.template = template
+        
+        product = self.mongo_db.products.Product()
+        product.name = u"Margherita"
+        product.parent = template._id
+        product.save()
+        self.product = product
+    
+    def test_inherited_properties(self):
+        """Product has definitions of properties of its template"""
+        
+        resp = self.client.get('/db/products/{}'.format(self.product._id))
+        data = json.loads(resp.data)
+        
+        self.assertEqual(data['size'], u"30")
+        self.assertEqual(len(data['properties']), 1)
+        prop = data['properties'][0]
+        self.assertEqual(prop['label'], u"Size, cm")
+        self.assertEqual(prop['options'], [u"30", u"40"])
+        self.assertEqual(prop['default_value'], u"30")
+
+    def test_pages_null_names(self):
+        """Products without name don't end paging early"""
+        
+        for name in [None, None, u"A", u"B"]:
+            product = self.mongo_db.products.Product()
+            product.name = name
+            product.save()
+        names = [p.get('name') for p in
+                 self.mongo_db.products.find({'is_template': False})]
+        
+        for sort in ('name', '-name'):
+            url = '/db/products?limit=2&fields=name&sort={}'.format(sort)
+            found = []
+            while url:
+                resp = self.client.get(url)
+                found.extend(p['name'] for p in json.loads(resp.data))
+                link = resp.headers.get('Link')
+                url = link[1:link.index('>')] if link else None
+            self.assertEqual(len(found), len(names),
+                             "Products are skipped sorted by " + sort)
+
+    def test_error_without_etag(self):
+        """ETag is set on successful responses only"""
+        
+        resp = self.client.get('/db/products?limit=2')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIsNotNone(resp.headers.get('ETag'))
+        
+        resp = self.client.get('/db/products?limit=2&cursor=invalid')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIsNone(resp.headers.get('ETag'), "ETag of error response")
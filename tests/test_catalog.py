@@ -0,0 +1,290 @@
+# coding: utf-8
+"""
+Testing catalog snapshot
+
+"""
+import zlib
+from unittest import TestCase, skipIf
+from flask import json
+from werkzeug.datastructures import Accept
+from werkzeug.http import parse_accept_header
+from mongokit import ObjectId
+from tests import AppTestCase
+import catalog
+
+
+class TestSnapshot(AppTestCase):
+    """
+    Test serialised catalog caching and invalidation
+
+    """
+
+    def setUp(self):
+        """Create visible category with one dish"""
+
+        category = self.mongo_db.categories.Category()
+        category.name = u"Pizzas"
+        category.is_hidden = False
+        category.save()
+        self.category = category
+
+        product = self.mongo_db.products.Product()
+        product.name = u"Margherita"
+        product.price = 10.0
+        product.is_hidden = False
+        product.categories = [category._id]
+        product.save()
+        self.product = product
+
+        self.snapshot = catalog.Snapshot(self.mongo_db)
+
+    def tearDown(self):
+        """Remove test data"""
+
+        self.mongo_db.categories.remove({'_id': self.category._id})
+        self.mongo_db.products.remove({'_id': self.product._id})
+
+    def test_payload_cached(self):
+        """Payload is built once until catalog is changed"""
+
+        payload = self.snapshot.get().payload
+        data = json.loads(payload)
+        self.assertIn(unicode(self.product._id), data['dishes'])
+
+        self.product.price = 12.0
+        self.product.save()
+        self.assertIs(self.snapshot.get().payload, payload,
+                      "Payload rebuilt without change notification")
+
+    def test_invalidated_on_change(self):
+        """Payload is rebuilt after catalog.changed()"""
+
+        self.snapshot.get()
+
+        self.product.price = 12.0
+        self.product.save()
+        catalog.changed(self.mongo_db)
+
+        data = json.loads(self.snapshot.get().payload)
+        dish = data['dishes'][unicode(self.product._id)]
+        self.assertEqual(dish['price'], 12.0, "Stale price in payload")
+
+    def test_version(self):
+        """Revision is bumped by catalog.changed() and hash follows content"""
+
+        revision, digest = self.snapshot.get_version()
+
+        self.product.price = 12.0
+        self.product.save()
+        new_revision = catalog.changed(self.mongo_db)
+        self.assertEqual(new_revision, revision + 1, "Revision isn't bumped")
+
+        self.assertEqual(self.snapshot.get_version()[0], new_revision)
+        self.assertNotEqual(self.snapshot.get_version()[1], digest,
+                            "Hash isn't changed with content")
+
+    def test_streaming(self):
+        """Streamed catalog is the same as snapshot"""
+
+        streamed = ''.join(catalog.iter_json(self.mongo_db, chunk_size = 1))
+        self.assertEqual(json.loads(streamed),
+                         json.loads(self.snapshot.get().payload))
+
+    def test_pages(self):
+        """Categories go first, then dishes"""
+
+        current = self.snapshot.get()
+
+        page, last = current.get_page(limit = 1)
+        self.assertEqual(page['categories'].keys(), [unicode(self.category._id)])
+        self.assertEqual(page['dishes'], {})
+        self.assertEqual(last, ("categories", unicode(self.category._id)))
+
+        page, last = current.get_page(last, limit = 1)
+        self.assertEqual(page['dishes'].keys(), [unicode(self.product._id)])
+        self.assertIsNone(last, "There are no more pages")
+
+
+class TestChanges(AppTestCase):
+    """
+    Test delta sync
+
+    """
+
+    def setUp(self):
+        """Create visible dish"""
+
+        product = self.mongo_db.products.Product()
+        product.name = u"Margherita"
+        product.price = 10.0
+        product.is_hidden = False
+        product.categories = [ObjectId()]
+        product.save()
+        self.product = product
+        self.revision = catalog.changed(self.mongo_db,
+                                        products = [product._id])
+
+    def tearDown(self):
+        """Remove test data"""
+
+        self.mongo_db.products.remove({'_id': self.product._id})
+
+    def test_upserted(self):
+        """Changed dish is returned"""
+
+        data = catalog.build_changes(self.mongo_db, self.revision - 1)
+        self.assertIn(unicode(self.product._id), data['dishes'])
+        self.assertEqual(data['revision'], self.revision)
+
+        data = catalog.build_changes(self.mongo_db, self.revision)
+        self.assertEqual(data['dishes'], {}, "Dish isn't changed since")
+
+    def test_deleted(self):
+        """Hidden dish is listed as deleted"""
+
+        self.product.is_hidden = True
+        self.product.save()
+        catalog.changed(self.mongo_db, products = [self.product._id])
+
+        data = catalog.build_changes(self.mongo_db, self.revision)
+        self.assertEqual(data['deleted']['dishes'], [unicode(self.product._id)])
+
+    def test_compacted(self):
+        """None is returned if change log doesn't cover revision"""
+
+        catalog.compact_changes(self.mongo_db, self.revision)
+        self.assertIsNone(catalog.build_changes(self.mongo_db, self.revision - 1))
+
+    def test_pending(self):
+        """Revision isn't reported until its changes are logged"""
+
+        first = catalog.reserve_revision(self.mongo_db)
+        second = catalog.reserve_revision(self.mongo_db)
+        catalog.log_changes(self.mongo_db, second)
+
+        data = catalog.build_changes(self.mongo_db, self.revision)
+        self.assertEqual(data['revision'], self.revision,
+                         "Revision with pending changes is reported")
+
+        catalog.log_changes(self.mongo_db, first,
+                            products = [self.product._id])
+
+        data = catalog.build_changes(self.mongo_db, self.revision)
+        self.assertEqual(data['revision'], second)
+        self.assertIn(unicode(self.product._id), data['dishes'])
+
+
+class TestEncoding(TestCase):
+    """
+    Test content coding negotiation and compression
+
+    """
+
+    def test_select_encoding(self):
+        """Best acceptable coding is selected"""
+
+        accept = parse_accept_header('gzip;q=0.5, deflate', Accept)
+        self.assertEqual(catalog.select_encoding(accept), 'gzip')
+
+        accept = parse_accept_header('gzip;q=0, deflate', Accept)
+        self.assertEqual(catalog.select_encoding(accept), 'identity')
+
+        accept = parse_accept_header('', Accept)
+        self.assertEqual(catalog.select_encoding(accept), 'identity')
+
+    def test_gzip(self):
+        """Compression is reversible and deterministic"""
+
+        data = json.dumps({"dishes": {}}) * 100
+        compressed = catalog.gzip_compress(data)
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS), data)
+        self.assertEqual(catalog.gzip_compress(data), compressed)
+
+    @skipIf(catalog.msgpack is None, "msgpack isn't installed")
+    def test_compact(self):
+        """ObjectIds are packed as binaries and keys are interned"""
+
+        id_ = ObjectId()
+        data = {
+            "collections": ["categories", "dishes"],
+            "categories": {},
+            "dishes": {
+                unicode(id_): {"id": id_, "label": u"Pizza", "categories": []},
+            },
+        }
+
+        packed = catalog.msgpack.unpackb(catalog.dump_compact(data),
+                                         encoding = 'utf-8')
+        dish = packed[u'dishes'][id_.binary]
+        keys = packed[u'keys']
+        self.assertEqual(dish[keys.index(u'id')], id_.binary)
+        self.assertEqual(dish[keys.index(u'label')], u'Pizza')
+
+class TestPropertyResolver(AppTestCase):
+    """
+    Test custom properties inheritance
+    
+    """
+    
+    def setUp(self):
+        """Create template with property and product overriding it"""
+        
+        template = self.mongo_db.products.Product()
+        template.name = u"Pizza"
+        template.is_template = True
+        template.save()
+        template.add_property(u"size", u"30", u"30")
+        template.add_property(u"spicy", False, False, order = 1)
+        self.template = template
+        
+        product = self.mongo_db.products.Product()
+        product.name = u"Margherita"
+        product.parent = template._id
+        product.save()
+        product.set_property(u"size", u"40")
+        self.product = product
+        
+        self.resolver = catalog.PropertyResolver(
+            self.mongo_db, catalog.RevisionCache(self.mongo_db))
+    
+    def tearDown(self):
+        """Remove test data"""
+        
+        self.mongo_db.products.remove(
+            {'_id': {'$in': [self.template._id, self.product._id]}})
+    
+    def test_resolve(self):
+        """Own entries override inherited ones"""
+        
+        props = self.resolver.resolve(self.product)
+        self.assertEqual([(p['name'], p['value']) for p in props],
+                         [(u"size", u"40"), (u"spicy", False)])
+    
+    def test_collapse(self):
+        """Copies of inherited entries are reduced to overridden fields"""
+        
+        self.mongo_db.products.update({'_id': self.product._id}, {'$set': {
+            'properties': [
+                dict(self.template.properties[0], value = u"40"),
+                dict(self.template.properties[1]),
+            ],
+        }})
+        
+        self.assertEqual(catalog.collapse_properties(self.mongo_db), 1)
+        self.product.reload()
+        self.assertEqual(self.product.properties,
+                         [{u"name": u"size", u"value": u"40"}])
+        
+        self.template.edit_property(u"size", label = u"Size, cm")
+        props = catalog.PropertyResolver(self.mongo_db).resolve(self.product)
+        self.assertEqual((props[0]['label'], props[0]['value']),
+                         (u"Size, cm", u"40"), "Template change isn't inherited")
+    
+    def test_invalidated(self):
+        """Template change is seen after catalog revision change"""
+        
+        self.resolver.resolve(self.product)
+        self.template.edit_property(u"spicy", value = True)
+        
+        self.assertEqual(self.product.get_properties(self.resolver)[u"spicy"],
+                         True, "Stale inherited property")
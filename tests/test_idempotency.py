@@ -0,0 +1,85 @@
+# coding: utf-8
+"""
+Testing idempotent requests
+
+"""
+from unittest import TestCase
+from tests import AppTestCase
+from idempotency import (IdempotencyStore, LRUCache, RequestInProgress,
+                         KeyReused)
+
+
+class TestLRUCache(TestCase):
+    """
+    Test LRU cache
+
+    """
+
+    def test_eviction(self):
+        """Least recently used key is dropped"""
+
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'), "Least recently used isn't dropped")
+
+
+class TestIdempotencyStore(AppTestCase):
+    """
+    Test stored responses
+
+    """
+
+    def setUp(self):
+        """Clean store"""
+
+        self.mongo_db.idempotency.remove()
+        self.store = IdempotencyStore(self.mongo_db)
+
+    def test_retry(self):
+        """Stored response is returned for the same key"""
+
+        self.assertIsNone(self.store.begin(u'order:1', 'a', 'f'))
+        self.assertRaises(RequestInProgress, self.store.begin,
+                          u'order:1', 'b', 'f')
+
+        self.store.finish(u'order:1', 'a', 200, 'application/json',
+                          '{"id": "1"}', 'f')
+
+        # other worker (no cached response)
+        store = IdempotencyStore(self.mongo_db)
+        self.assertEqual(store.begin(u'order:1', 'c', 'f'),
+                         (200, 'application/json', '{"id": "1"}'))
+
+    def test_reused(self):
+        """Key can't be reused with other content"""
+
+        self.store.begin(u'order:4', 'a', 'f')
+        self.store.finish(u'order:4', 'a', 200, 'application/json', '{}', 'f')
+
+        self.assertRaises(KeyReused, self.store.begin, u'order:4', 'b', 'g')
+        store = IdempotencyStore(self.mongo_db)
+        self.assertRaises(KeyReused, store.begin, u'order:4', 'b', 'g')
+
+    def test_cancel(self):
+        """Cancelled key may be reserved again"""
+
+        self.store.begin(u'order:2', 'a')
+        self.store.cancel(u'order:2', 'a')
+        self.assertIsNone(self.store.begin(u'order:2', 'b'))
+
+    def test_stale(self):
+        """Reservation of dead request is taken over"""
+
+        store = IdempotencyStore(self.mongo_db, lock_timeout = -1)
+        store.begin(u'order:3', 'a')
+        self.assertIsNone(store.begin(u'order:3', 'b'))
+
+        # taken over reservation isn't released or finished by old owner
+        store.cancel(u'order:3', 'a')
+        self.assertFalse(store.finish(u'order:3', 'a', 200, 'text/plain', ''))
+        self.assertTrue(store.finish(u'order:3', 'b', 200, 'text/plain', ''))
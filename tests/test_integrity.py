@@ -0,0 +1,125 @@
+# coding: utf-8
+"""
+Testing cascade deletes and orphans sweeping
+
+"""
+from mongokit import ObjectId
+from tests import AppTestCase
+import integrity
+
+
+class TestIntegrity(AppTestCase):
+    """
+    Test references cleaning
+    
+    Pizzas
+     |-Vegetarian
+    
+    Margherita (in Vegetarian)
+    
+    """
+    
+    def setUp(self):
+        """Create categories with product"""
+        
+        self.mongo_db.categories.remove()
+        self.mongo_db.products.remove()
+        
+        pizzas = self.mongo_db.categories.Category()
+        pizzas.name = u"Pizzas"
+        pizzas.save()
+        self.pizzas = pizzas
+        
+        vegetarian = self.mongo_db.categories.Category()
+        vegetarian.name = u"Vegetarian"
+        vegetarian.parent = pizzas._id
+        vegetarian.save()
+        self.vegetarian = vegetarian
+        
+        product = self.mongo_db.products.Product()
+        product.name = u"Margherita"
+        product.categories = [vegetarian._id]
+        product.save()
+        self.product = product
+        
+        vegetarian.items_order = [product._id]
+        vegetarian.save()
+    
+    def test_delete_reparent(self):
+        """Children are moved to parent"""
+        
+        integrity.delete_categories(self.mongo_db, self.pizzas._id)
+        
+        self.vegetarian.reload()
+        self.assertIsNone(self.vegetarian.parent)
+        self.assertEqual(self.vegetarian.ancestors, [])
+    
+    def test_delete_subtree(self):
+        """Subtree is deleted and references are removed"""
+        
+        categories, products = integrity.delete_categories(
+            self.mongo_db, self.pizzas._id, integrity.SUBTREE)
+        
+        self.assertEqual(self.mongo_db.categories.count(), 0)
+        self.assertEqual(products, [self.product._id])
+        self.product.reload()
+        self.assertEqual(self.product.categories, [])
+    
+    def test_delete_product(self):
+        """Product is removed from categories"""
+        
+        integrity.delete_products(self.mongo_db, self.product._id)
+        
+        self.vegetarian.reload()
+        self.assertEqual(self.vegetarian.items_order, [])
+    
+    def test_delete_template(self):
+        """Descendants keep properties of deleted template"""
+        
+        template = self.mongo_db.products.Product()
+        template.name = u"Pizza"
+        template.is_template = True
+        template.save()
+        template.add_property(u"size", u"30", u"30")
+        template.add_property(u"spicy", False, False)
+        
+        self.product.parent = template._id
+        self.product.save()
+        self.product.add_property(u"size", u"40", u"40")
+        
+        child = self.mongo_db.products.Product()
+        child.name = u"Margherita XL"
+        child.parent = self.product._id
+        child.save()
+        
+        categories, products = integrity.delete_products(self.mongo_db,
+                                                         template._id)
+        self.assertEqual(set(products),
+                         set([template._id, self.product._id, child._id]))
+        
+        self.product.reload()
+        self.assertEqual(self.product.ancestors, [])
+        self.assertEqual(dict(self.product.get_properties()),
+                         {u"size": u"40", u"spicy": False})
+        child.reload()
+        self.assertEqual(child.ancestors, [self.product._id])
+        self.assertEqual(child.get_property(u"spicy"), False)
+    
+    def test_sweep_orphans(self):
+        """Dangling references are reported and repaired"""
+        
+        missing = ObjectId()
+        self.mongo_db.products.update({'_id': self.product._id},
+                                      {'$push': {'categories': missing}})
+        self.mongo_db.categories.remove({'_id': self.pizzas._id})
+        
+        report = integrity.sweep_orphans(self.mongo_db)
+        self.assertEqual(report['products.categories'], [self.product._id])
+        self.assertEqual(report['categories.parent'], [self.vegetarian._id])
+        
+        report = integrity.sweep_orphans(self.mongo_db, repair = True)
+        self.assertEqual(report['categories.ancestors'], 1)
+        
+        report = integrity.sweep_orphans(self.mongo_db)
+        self.assertEqual(report['products.categories'], [])
+        self.assertEqual(report['categories.parent'], [])
@@ -3,7 +3,11 @@
 Testing models behavior
 
 """
+from unittest import TestCase
 from tests import AppTestCase
+from models.base import get_update, get_guards
+import catalog
+import tree
 #from models import Product
 
 
@@ -69,15 +73,13 @@ class TestProduct(AppTestCase):
         #self.mongo_db.products.drop()
     
     def test_add_property(self):
-        """Check if property added to all descendants"""
+        """Check if property is inherited by all descendants"""
         
-        #products_collection = self.mongo_db.products
-        
-        # check property on common product
-        #subproduct = products_collection.Product.find_one({"name": u"Pizza (supper)"})
         self.subproduct.reload()
-        num = len(self.subproduct.properties)
-        self.assertEqual(num, 1, "Wrong quantity of product properties: " + str(num))
+        self.assertEqual(len(self.subproduct.properties), 0,
+                         "Property is copied to subproduct")
+        self.assertEqual(self.subproduct.get_properties(), {u"is_flag": True},
+                         "Property isn't inherited")
         
     def test_del_property(self):
         """Check if property is deleted on descendants"""
@@ -94,6 +96,9 @@ class TestProduct(AppTestCase):
         # not recursively
         self.assertEqual(len(product.properties), 1, "Wrong quantity of product properties")
         self.assertEqual(product.properties[0]['is_deleted'], True, "Property isn't marked as deleted")
+        subproduct.reload()
+        self.assertIsNone(subproduct.get_property("is_flag"),
+                          "Deleted property is inherited")
         
         # recursively
         product.del_property("is_flag", True)
@@ -103,5 +108,172 @@ class TestProduct(AppTestCase):
         subproduct.reload()
         self.assertEqual(len(subproduct.properties), 0, "Wrong quantity of properties on subproduct")
     
+    def test_del_property_missing(self):
+        """Catalog isn't changed if nothing is deleted"""
+        
+        revision = catalog.get_revision(self.mongo_db)[0]
+        self.template.del_property(u"missing", True)
+        self.assertEqual(catalog.get_revision(self.mongo_db)[0], revision,
+                         "Catalog change is logged")
+    
+    def test_edit_property(self):
+        """Check if property is changed on descendants"""
+        
+        self.template.edit_property("is_flag", value = False)
+        
+        self.subproduct.reload()
+        self.assertEqual(self.subproduct.get_property("is_flag"), False,
+                         "Property isn't changed on subproduct")
     
+    def test_ancestors(self):
+        """Check if ancestors path follows parent changes"""
+        
+        self.subproduct.reload()
+        self.assertEqual(self.subproduct.ancestors,
+                         [self.template._id, self.product._id])
+        
+        # move product to top
+        self.product.reload()
+        self.product.parent = None
+        self.product.save()
+        
+        self.subproduct.reload()
+        self.assertEqual(self.subproduct.ancestors, [self.product._id],
+                         "Descendant path isn't fixed")
+    
+    def test_remove_node(self):
+        """Check if children are moved to parent of removed node"""
+        
+        tree.remove_node(self.mongo_db.products, self.product._id)
+        
+        self.subproduct.reload()
+        self.assertEqual(self.subproduct.parent, self.template._id)
+        self.assertEqual(self.subproduct.ancestors, [self.template._id])
+    
+    def test_move(self):
+        """Check if subtree is moved and cycles are rejected"""
+        
+        products = self.mongo_db.products
+        
+        self.assertRaises(tree.CycleError, tree.move, products,
+                          self.template._id, self.subproduct._id)
+        
+        moved = tree.move(products, self.product._id, None)
+        self.assertEqual(moved, [self.product._id, self.subproduct._id])
+        
+        self.subproduct.reload()
+        self.assertEqual(self.subproduct.ancestors, [self.product._id],
+                         "Descendant path isn't fixed")
+    
+    def test_override_fields(self):
+        """Check if only overridden fields are stored on descendant"""
+        
+        self.product.reload()
+        self.product.set_property(u"is_flag", False)
+        self.assertEqual(self.product.properties,
+                         [{u"name": u"is_flag", u"value": False}])
+        
+        self.template.edit_property(u"is_flag", label = u"Flag")
+        props = catalog.PropertyResolver(self.mongo_db).resolve(self.product)
+        self.assertEqual((props[0]['label'], props[0]['value']),
+                         (u"Flag", False))
     
+    def test_properties_view(self):
+        """Check if properties view follows property changes"""
+        
+        self.product.reload()
+        props = self.product.get_properties()
+        self.assertEqual(dict(props), {u"is_flag": True})
+        self.assertIs(self.product.get_properties(), props,
+                      "Inherited entries aren't memoized")
+        self.assertRaises(TypeError, props.__setitem__, u"is_flag", False)
+        
+        self.product.set_property(u"is_flag", False)
+        self.assertEqual(self.product.get_property(u"is_flag"), False)
+        
+        self.product.add_property(u"size", u"30", u"30")
+        self.assertEqual(self.product.get_property(u"size"), u"30")
+        self.assertEqual(len(self.product.get_properties()), 2)
+    
+    def test_property_renamed(self):
+        """Check if entries replaced in place are found by new name"""
+        
+        template = self.template
+        template.get_properties()
+        template.properties[0] = dict(template.properties[0],
+                                      name = u"is_new")
+        
+        self.assertEqual(template.get_property(u"is_new"), True)
+        self.assertIsNone(template.get_property(u"is_flag"))
+    
+    def test_partial_save(self):
+        """Check if only changed fields are saved"""
+        
+        self.subproduct.reload()
+        self.subproduct.price = 20.0
+        self.assertEqual(self.subproduct.get_update(),
+                         {'$set': {'price': 20.0}})
+        
+        # concurrent change of other field isn't overwritten
+        self.mongo_db.products.update({'_id': self.subproduct._id},
+                                      {'$set': {'name': u"Pizza (mega)"}})
+        self.subproduct.save()
+        
+        self.subproduct.reload()
+        self.assertEqual(self.subproduct.price, 20.0)
+        self.assertEqual(self.subproduct.name, u"Pizza (mega)")
+    
+    def test_partial_save_moved(self):
+        """Entry isn't changed by index if entries were moved concurrently"""
+        
+        self.subproduct.add_property(u"a", u"1", u"1")
+        self.subproduct.add_property(u"b", u"2", u"2")
+        index = [p['name'] for p in self.subproduct.properties].index(u"b")
+        
+        self.mongo_db.products.update({'_id': self.subproduct._id},
+            {'$pull': {'properties': {'name': u"a"}}})
+        self.subproduct.properties[index]['value'] = u"3"
+        self.subproduct.save()
+        
+        doc = self.mongo_db.products.find_one({'_id': self.subproduct._id})
+        values = dict((p['name'], p['value']) for p in doc['properties'])
+        self.assertEqual(values[u"b"], u"3")
+
+
+class TestGetUpdate(TestCase):
+    """
+    Test changes to update conversion
+    
+    """
+    
+    def test_nested(self):
+        """Changed paths are set, removed are unset"""
+        
+        old = {'a': {'b': 1, 'c': 2}, 'l': [{'k': 1, 'v': 1},
+                                            {'k': 2, 'v': 2}], 'x': 1}
+        new = {'a': {'b': 1, 'c': 3}, 'l': [{'k': 1, 'v': 1},
+                                            {'k': 2, 'v': True}]}
+        update = get_update(old, new, {'l': 'k'})
+        self.assertEqual(update, {
+            '$set': {'a.c': 3, 'l.1.v': True},
+            '$unset': {'x': 1},
+        })
+        self.assertEqual(get_guards(old, update, {'l': 'k'}), {'l.1.k': 2})
+        
+        # list items without keys aren't set by index
+        self.assertEqual(get_update(old, new), {
+            '$set': {'a.c': 3, 'l': new['l']},
+            '$unset': {'x': 1},
+        })
+    
+    def test_lists(self):
+        """Appended items are pushed, removed are pulled"""
+        
+        self.assertEqual(get_update({'l': [1, 2]}, {'l': [1, 2, 3]}),
+                         {'$push': {'l': {'$each': [3]}}})
+        self.assertEqual(get_update({'l': [1, 2, 3]}, {'l': [1, 3]}),
+                         {'$pull': {'l': {'$in': [2]}}})
+        self.assertEqual(get_update({'l': [1, 2]}, {'l': [2]}),
+                         {'$pull': {'l': {'$in': [1]}}})
+        self.assertEqual(get_update({'l': [1, 2]}, {'l': [3]}),
+                         {'$set': {'l': [3]}})
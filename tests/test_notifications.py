@@ -0,0 +1,170 @@
+# coding: utf-8
+"""
+Testing background email notifications
+
+"""
+import asyncore
+import smtpd
+import socket
+import threading
+import time
+from datetime import datetime
+from flask.ext.mail import Mail
+from tests import AppTestCase
+from notifications import Outbox
+
+
+class StandInSMTPServer(smtpd.SMTPServer):
+    """Local SMTP server collecting received messages"""
+
+    def __init__(self, localaddr):
+        smtpd.SMTPServer.__init__(self, localaddr, None)
+        self.messages = []
+        self.connections = 0
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+
+def free_port():
+    """Get free local TCP port"""
+
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestOutbox(AppTestCase):
+    """
+    Test sending messages through outbox
+
+    """
+
+    def setUp(self):
+        """Point mail to local stand-in SMTP server"""
+
+        self.port = free_port()
+        self.app.config['MAIL_SERVER'] = 'localhost'
+        self.app.config['MAIL_PORT'] = self.port
+        self.app.config['MAIL_DEBUG'] = False
+        # flask-mail doesn't send anything in testing mode by default
+        self.app.config['MAIL_SUPPRESS_SEND'] = False
+        self.mail = Mail(self.app)
+        self.mongo_db.outbox.remove()
+
+    def start_server(self):
+        """Run stand-in SMTP server in background thread"""
+
+        server = StandInSMTPServer(('localhost', self.port))
+        thread = threading.Thread(target = asyncore.loop,
+                                  kwargs = {'timeout': 0.1})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.close)
+        return server
+
+    def test_send(self):
+        """Message is delivered and removed from outbox"""
+
+        server = self.start_server()
+        outbox = Outbox(self.app, self.mail, self.mongo_db, workers = 1)
+        outbox.start()
+        outbox.send(u'[FOOD] new order', 'order@example.com',
+                    ['staff@example.com'], u'Order text')
+        outbox.stop()
+
+        self.assertEqual(len(server.messages), 1, "Message isn't delivered")
+        self.assertEqual(server.messages[0][1], ['staff@example.com'])
+        self.assertEqual(self.mongo_db.outbox.count(), 0)
+
+    def test_give_up(self):
+        """Message is marked failed after last attempt"""
+
+        # no server is listening
+        outbox = Outbox(self.app, self.mail, self.mongo_db, workers = 1,
+                        max_attempts = 1)
+        outbox.start()
+        id_ = outbox.send(u'[FOOD] new order', 'order@example.com',
+                          ['staff@example.com'], u'Order text')
+        outbox.stop()
+
+        doc = self.mongo_db.outbox.find_one({'_id': id_})
+        self.assertEqual(doc['status'], u'failed')
+        self.assertEqual(doc['attempts'], 1)
+
+    def test_resume(self):
+        """Messages left by stopped process are sent on start"""
+
+        outbox = Outbox(self.app, self.mail, self.mongo_db, workers = 1)
+        outbox.send(u'[FOOD] new order', 'order@example.com',
+                    ['staff@example.com'], u'Order text')
+        # not sent: there are no workers, lease is released
+        outbox.stop()
+
+        server = self.start_server()
+        outbox = Outbox(self.app, self.mail, self.mongo_db, workers = 1)
+        outbox.start()
+        outbox.stop()
+
+        self.assertEqual(len(server.messages), 1, "Message isn't delivered")
+
+    def test_rescan(self):
+        """Messages with expired lease are picked up by running process"""
+
+        server = self.start_server()
+        outbox = Outbox(self.app, self.mail, self.mongo_db, workers = 1,
+                        scan_interval = 0.1)
+        outbox.start()
+
+        # process crashed before sending
+        crashed = Outbox(self.app, self.mail, self.mongo_db, lease = 0)
+        crashed.send(u'[FOOD] new order', 'order@example.com',
+                     ['staff@example.com'], u'Order text')
+
+        time.sleep(0.5)
+        outbox.stop()
+
+        self.assertEqual(len(server.messages), 1, "Message isn't delivered")
+
+    def test_batch(self):
+        """Messages queued together are sent over one connection"""
+
+        server = self.start_server()
+        outbox = Outbox(self.app, self.mail, self.mongo_db, workers = 1)
+        for i in range(3):
+            outbox.send(u'[FOOD] new order', 'order@example.com',
+                        ['staff@example.com'], u'Order text')
+        outbox.start()
+        outbox.stop()
+
+        self.assertEqual(len(server.messages), 3, "Messages aren't delivered")
+        self.assertEqual(server.connections, 1, "Connection isn't reused")
+
+    def test_stop_in_flight(self):
+        """Message being sent when stop times out keeps its lease"""
+
+        outbox = Outbox(self.app, self.mail, self.mongo_db, workers = 1)
+        sending = threading.Event()
+        sent = threading.Event()
+
+        def deliver(docs):
+            sending.set()
+            sent.wait(5)
+
+        outbox._deliver = deliver
+        outbox.start()
+        id_ = outbox.send(u'[FOOD] new order', 'order@example.com',
+                          ['staff@example.com'], u'Order text')
+        sending.wait(5)
+        outbox.stop(timeout = 0.1)
+        sent.set()
+
+        doc = self.mongo_db.outbox.find_one({'_id': id_})
+        self.assertGreater(doc['locked_until'], datetime.now(),
+                           "Lease of message being sent is released")
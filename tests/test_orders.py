@@ -0,0 +1,71 @@
+# coding: utf-8
+"""
+Testing write-behind order persistence
+
+"""
+from datetime import datetime
+from mongokit import ObjectId
+from tests import AppTestCase
+from orders import OrderWriter, BufferFull
+
+
+class TestOrderWriter(AppTestCase):
+    """
+    Test buffering and bulk writing of orders
+
+    """
+
+    def setUp(self):
+        """Clean orders"""
+
+        self.mongo_db.orders.remove()
+
+    def make_order(self):
+        """Create valid order document"""
+
+        order = self.mongo_db.orders.Order()
+        order['_id'] = ObjectId()
+        order['person'] = {
+            "firstname": u"John",
+            "lastname": u"Doe",
+            "fathersname": u"",
+        }
+        order['address'] = {"street": u"Main"}
+        order['phones'] = [u"555-55-55"]
+        order['datetime'] = datetime.now()
+        order['secret'] = u"secret"
+        order['cart'] = []
+        return order
+
+    def test_flush_on_stop(self):
+        """Buffered orders are written on stop"""
+
+        writer = OrderWriter(self.app, self.mongo_db, batch_size = 10,
+                             flush_interval = 60)
+        writer.start()
+        for i in range(3):
+            writer.accept(self.make_order())
+        writer.stop()
+
+        self.assertEqual(self.mongo_db.orders.count(), 3)
+
+    def test_acknowledged(self):
+        """Order is written when accept() returns"""
+
+        writer = OrderWriter(self.app, self.mongo_db, acknowledged = True,
+                             flush_interval = 60)
+        writer.start()
+        order = self.make_order()
+        writer.accept(order)
+
+        self.assertIsNotNone(self.mongo_db.orders.find_one({'_id': order['_id']}))
+        writer.stop()
+
+    def test_backpressure(self):
+        """Full buffer rejects orders"""
+
+        # not started, nothing is flushed
+        writer = OrderWriter(self.app, self.mongo_db, max_size = 1)
+        writer.accept(self.make_order())
+
+        self.assertRaises(BufferFull, writer.accept, self.make_order())
@@ -0,0 +1,169 @@
+# coding: utf-8
+"""
+Testing bulk import and export
+
+"""
+from mongokit import ObjectId
+from pymongo.errors import PyMongoError
+from tests import AppTestCase
+import catalog
+import transfer
+
+
+class TestTransfer(AppTestCase):
+    """
+    Test export and import of products
+    
+    """
+    
+    def setUp(self):
+        """Create template with product"""
+        
+        self.mongo_db.categories.remove()
+        self.mongo_db.products.remove()
+        
+        category = self.mongo_db.categories.Category()
+        category.name = u"Pizzas"
+        category.save()
+        self.category = category
+        
+        template = self.mongo_db.products.Product()
+        template.name = u"Pizza"
+        template.is_template = True
+        template.save()
+        self.template = template
+        
+        product = self.mongo_db.products.Product()
+        product.name = u"Маргарита"
+        product.price = 10.0
+        product.parent = template._id
+        product.categories = [category._id]
+        product.save()
+        product.add_property(u"size", u"большая", u"большая",
+                             label = u"Размер")
+        self.product = product
+    
+    def roundtrip(self, format_):
+        """Export products, remove them and import back"""
+        
+        data = ''.join(transfer.iter_export(self.mongo_db, 'products', format_))
+        self.mongo_db.products.remove()
+        
+        importer = transfer.Importer(self.mongo_db, 'products', batch_size = 1)
+        return importer.run(transfer.iter_rows(data.splitlines(True), format_))
+    
+    def test_jsonl(self):
+        """Products are imported back with paths and categories"""
+        
+        report = self.roundtrip('jsonl')
+        self.assertEqual(report, {"inserted": 2, "errors": []})
+        
+        product = self.mongo_db.products.find_one({'_id': self.product._id})
+        self.assertEqual(product['ancestors'], [self.template._id])
+        self.assertEqual(product['price'], 10.0)
+        self.assertEqual(product['name'], u"Маргарита")
+        self.category.reload()
+        self.assertEqual(self.category.items_order, [self.product._id])
+    
+    def test_not_backfilled(self):
+        """Documents without paths are exported with roots"""
+        
+        self.mongo_db.products.update({'_id': self.product._id},
+                                      {'$unset': {'ancestors': 1}})
+        
+        report = self.roundtrip('jsonl')
+        self.assertEqual(report['inserted'], 2)
+    
+    def test_csv(self):
+        """CSV is imported back"""
+        
+        report = self.roundtrip('csv')
+        self.assertEqual(report, {"inserted": 2, "errors": []})
+        
+        product = self.mongo_db.products.find_one({'_id': self.product._id})
+        self.assertEqual(product['categories'], [self.category._id])
+        self.assertEqual(product['properties'][0]['value'], u"большая")
+    
+    def test_errors(self):
+        """Bad rows are reported by line"""
+        
+        lines = [
+            '{"name": "Ok", "price": 1.0}\n',
+            'not json\n',
+            '{"name": "Orphan", "parent": "%s"}\n' % ObjectId(),
+            '{"name": "Bad price", "price": "free"}\n',
+        ]
+        importer = transfer.Importer(self.mongo_db, 'products')
+        report = importer.run(transfer.iter_rows(lines, 'jsonl'))
+        
+        self.assertEqual(report['inserted'], 1)
+        self.assertEqual([e['line'] for e in report['errors']], [2, 3, 4])
+    
+    def test_rejected_parent(self):
+        """Children of rejected rows and repeated ids aren't imported"""
+        
+        parent_id, child_id, copy_id = ObjectId(), ObjectId(), ObjectId()
+        lines = [
+            '{"id": "%s", "name": "Lost", "categories": ["%s"]}\n' % (
+                parent_id, ObjectId()),
+            '{"id": "%s", "name": "Child", "parent": "%s"}\n' % (
+                child_id, parent_id),
+            '{"name": "Ok", "price": 1.0}\n',
+            '{"id": "%s", "name": "First"}\n' % copy_id,
+            '{"id": "%s", "name": "Second"}\n' % copy_id,
+        ]
+        importer = transfer.Importer(self.mongo_db, 'products')
+        report = importer.run(transfer.iter_rows(lines, 'jsonl'))
+        
+        self.assertEqual(report['inserted'], 2)
+        self.assertEqual([e['line'] for e in report['errors']], [1, 2, 5])
+        self.assertIsNone(self.mongo_db.products.find_one({'_id': child_id}))
+        copy = self.mongo_db.products.find_one({'_id': copy_id})
+        self.assertEqual(copy['name'], u"First")
+    
+    def test_stopped(self):
+        """Batches inserted before DB error are reported and logged"""
+        
+        lines = ['{"name": "First"}\n', '{"name": "Second"}\n']
+        importer = transfer.Importer(self.mongo_db, 'products', batch_size = 1)
+        check_ids = importer._check_ids
+        
+        def check_ids_failing(batch):
+            if importer.inserted:
+                raise PyMongoError("Connection lost")
+            return check_ids(batch)
+        
+        importer._check_ids = check_ids_failing
+        revision = catalog.get_revision(self.mongo_db)[0]
+        report = importer.run(transfer.iter_rows(lines, 'jsonl'))
+        
+        self.assertEqual(report['inserted'], 1)
+        self.assertEqual([e['line'] for e in report['errors']], [2])
+        self.assertEqual(catalog.get_revision(self.mongo_db)[0], revision + 1,
+                         "Inserted products aren't logged")
+    
+    def test_items_order(self):
+        """Order of category items survives export and import"""
+        
+        other = self.mongo_db.products.Product()
+        other.name = u"Пепперони"
+        other.categories = [self.category._id]
+        other.save()
+        self.category.items_order = [other._id, ObjectId(), self.product._id]
+        self.category.save()
+        
+        data = dict(
+            (name, ''.join(transfer.iter_export(self.mongo_db, name, 'csv')))
+            for name in ('categories', 'products')
+        )
+        self.mongo_db.categories.remove()
+        self.mongo_db.products.remove()
+        for name in ('categories', 'products'):
+            importer = transfer.Importer(self.mongo_db, name)
+            report = importer.run(
+                transfer.iter_rows(data[name].splitlines(True), 'csv'))
+            self.assertEqual(report['errors'], [])
+        
+        self.category.reload()
+        self.assertEqual(self.category.items_order,
+                         [other._id, self.product._id])
@@ -0,0 +1,56 @@
+# coding: utf-8
+"""
+Testing in-memory tree navigation
+
+"""
+from unittest import TestCase
+from mongokit import ObjectId
+import tree
+
+
+class TestTree(TestCase):
+    """
+    Test children ordering, subtree and path queries
+    
+    root
+     |-first (order 0)
+     |  |-leaf (hidden)
+     |-second (order 1)
+    
+    """
+    
+    def setUp(self):
+        """Build tree of plain documents"""
+        
+        self.root, self.first, self.second, self.leaf = \
+            [ObjectId() for i in range(4)]
+        self.tree = tree.Tree(1, [
+            {'_id': self.root, 'parent': None, 'name': u"Root"},
+            {'_id': self.second, 'parent': self.root, 'name': u"B", 'order': 1},
+            {'_id': self.first, 'parent': self.root, 'name': u"A", 'order': 0},
+            {'_id': self.leaf, 'parent': self.first, 'name': u"C",
+             'is_hidden': True},
+        ])
+    
+    def test_children(self):
+        """Children are ordered"""
+        
+        self.assertEqual(self.tree.get_children(self.root),
+                         [self.first, self.second])
+        self.assertEqual(self.tree.get_children(None), [self.root])
+    
+    def test_subtree(self):
+        """Subtree is depth first with relative depth"""
+        
+        self.assertEqual(list(self.tree.iter_subtree(self.root)), [
+            (self.root, 0), (self.first, 1), (self.leaf, 2), (self.second, 1),
+        ])
+        self.assertEqual(list(self.tree.iter_subtree(self.root, 1, True)), [
+            (self.root, 0), (self.first, 1), (self.second, 1),
+        ])
+    
+    def test_path(self):
+        """Path goes from root"""
+        
+        self.assertEqual(self.tree.get_path(self.leaf),
+                         [self.root, self.first, self.leaf])
@@ -0,0 +1,502 @@
+# coding: utf-8
+"""
+Bulk import and export of categories and products
+
+Rows are JSON Lines (one JSON object per line) or CSV with header row.
+Row has fields listed in FIELDS, 'id' is the document _id. In CSV lists
+are JSON encoded and empty cell is missing value.
+
+Export goes level by level (roots first), so exported file can be
+imported back: parent must come before its children. Both directions
+are streamed, import writes documents in batches with bulk inserts and
+reports errors by line.
+
+Categories are imported before products (products refer to them), so
+'items_order' of imported category may list products which aren't
+imported yet. Imported products keep their places in it, products which
+are still missing are removed from orders of categories the products
+import has changed.
+
+"""
+import csv
+from cStringIO import StringIO
+from flask import json
+from mongokit import (ObjectId, StructureError, SchemaTypeError,
+                      AuthorizedTypeError, RequireFieldError, ValidationError)
+from bson.errors import InvalidId
+from pymongo.errors import PyMongoError
+import catalog
+
+
+FORMATS = ('jsonl', 'csv')
+
+MIMETYPES = {
+    'jsonl': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# exported fields and their types
+FIELDS = {
+    'categories': [
+        ('id', ObjectId),
+        ('parent', ObjectId),
+        ('name', unicode),
+        ('description', unicode),
+        ('icon_small', unicode),
+        ('icon_big', unicode),
+        ('is_hidden', bool),
+        ('order', int),
+        ('items_order', list),
+    ],
+    'products': [
+        ('id', ObjectId),
+        ('parent', ObjectId),
+        ('name', unicode),
+        ('description', unicode),
+        ('price', float),
+        ('units', unicode),
+        ('icon_small', unicode),
+        ('icon_big', unicode),
+        ('is_template', bool),
+        ('is_hidden', bool),
+        ('categories', list),
+        ('properties', list),
+    ],
+}
+
+# mongokit documents of collections
+DOCUMENTS = {
+    'categories': 'Category',
+    'products': 'Product',
+}
+
+
+#
+# Export
+#
+
+def iter_docs(collection, fields):
+    """
+    Generate documents level by level, roots first
+
+    Documents without 'ancestors' (not backfilled, see manage.py
+    backfill_ancestors) go with roots, so they aren't lost but may come
+    before their parents.
+
+    """
+
+    projection = [name for name, type_ in fields if name != 'id']
+
+    level = 0
+    while True:
+        found = False
+        spec = {'ancestors': {'$size': level}}
+        if level == 0:
+            spec = {'$or': [spec, {'ancestors': None}]}
+        cursor = collection.find(spec, projection)
+        for doc in cursor.sort('_id', 1):
+            found = True
+            yield doc
+        if not found:
+            return
+        level += 1
+
+def to_csv_value(value):
+    """Encode value for CSV cell"""
+
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (list, dict)):
+        return catalog.dump_json(value)
+
+    return unicode(value).encode('utf-8')
+
+def iter_export(db, name, format_):
+    """
+    Generate exported rows of collection name ('categories' or
+    'products') as lines of format_
+
+    Lines are UTF-8 encoded. Must be iterated in app context (JSON
+    encoder of the app is used).
+
+    """
+
+    fields = FIELDS[name]
+    names = [field for field, type_ in fields]
+
+    if format_ == 'csv':
+        buf = StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(names)
+
+    for doc in iter_docs(db[name], fields):
+        row = [doc['_id'] if field == 'id' else doc.get(field)
+               for field in names]
+
+        if format_ == 'jsonl':
+            yield catalog.dump_json(dict(zip(names, row))) + '\n'
+            continue
+
+        writer.writerow([to_csv_value(value) for value in row])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+    if format_ == 'csv' and buf.getvalue():
+        yield buf.getvalue()
+
+
+#
+# Import
+#
+
+def iter_rows(lines, format_):
+    """Generate (line number, row dict or None, error or None)"""
+
+    if format_ == 'jsonl':
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield number, None, u"Invalid JSON: {}".format(e)
+                continue
+            if not isinstance(row, dict):
+                yield number, None, u"Row must be an object"
+                continue
+            yield number, row, None
+        return
+
+    reader = csv.reader(lines)
+    try:
+        header = [h.decode('utf-8') for h in next(reader)]
+    except StopIteration:
+        return
+    for row in reader:
+        if not row:
+            continue
+        values = [v.decode('utf-8') for v in row]
+        yield reader.line_num, dict(zip(header, values)), None
+
+def convert(value, type_):
+    """Convert row value to field type"""
+
+    if type_ is ObjectId:
+        return ObjectId(value)
+    if type_ is bool:
+        if isinstance(value, bool):
+            return value
+        if value in (u'true', u'1'):
+            return True
+        if value in (u'false', u'0'):
+            return False
+        raise ValueError(u"Invalid boolean {!r}".format(value))
+    if type_ is list:
+        if isinstance(value, basestring):
+            value = json.loads(value)
+        if not isinstance(value, list):
+            raise ValueError(u"Invalid list {!r}".format(value))
+        return value
+
+    return type_(value)
+
+def to_doc(name, row):
+    """Make document (without validation) from row, raise ValueError"""
+
+    doc = {}
+    for field, type_ in FIELDS[name]:
+        value = row.get(field)
+        if value is None or value == u'':
+            continue
+        try:
+            value = convert(value, type_)
+            if field in ('categories', 'items_order'):
+                value = [ObjectId(c) for c in value]
+                if len(set(value)) != len(value):
+                    raise ValueError(u"Repeated ids")
+        except (ValueError, TypeError, InvalidId) as e:
+            raise ValueError(u"Invalid {}: {}".format(field, e))
+        doc['_id' if field == 'id' else field] = value
+
+    if '_id' not in doc:
+        doc['_id'] = ObjectId()
+
+    return doc
+
+
+class Importer(object):
+    """
+    Import rows into collection name ('categories' or 'products')
+
+    Parents and categories of a batch are checked with one query each,
+    documents are validated by models and inserted by one insert. Parent
+    must be in DB or imported before its children.
+
+    """
+
+    def __init__(self, db, name, batch_size=500):
+        self.db = db
+        self.name = name
+        self.collection = db[name]
+        self.batch_size = batch_size
+
+        # ancestors of inserted documents (for their children)
+        self.ancestors = {}
+        self.inserted = []
+        self.changed_categories = set()
+        self.errors = []
+        self._batch = []
+
+    def run(self, rows):
+        """
+        Import rows from iter_rows()
+
+        Returns report dict: "inserted" - number of inserted documents,
+        "errors" - list of {"line", "error"}. Import stops on DB error, it's
+        reported with the last read line. Documents inserted before are
+        kept and logged as changed anyway.
+
+        """
+
+        number = 0
+        try:
+            for number, row, error in rows:
+                if error is None:
+                    try:
+                        self._batch.append((number, to_doc(self.name, row)))
+                    except ValueError as e:
+                        error = unicode(e)
+                if error is not None:
+                    self._error(number, error)
+                if len(self._batch) >= self.batch_size:
+                    self.flush()
+            self.flush()
+            if self.name == 'products':
+                self._check_items_order()
+        except PyMongoError as e:
+            self._error(number, u"Import stopped: {}".format(e))
+        finally:
+            self._log_changes()
+
+        return {
+            "inserted": len(self.inserted),
+            "errors": sorted(self.errors, key = lambda e: e['line']),
+        }
+
+    def _log_changes(self):
+        """Log inserted documents in catalog change log"""
+
+        if self.name == 'categories' and self.inserted:
+            catalog.changed(self.db, categories = self.inserted)
+        elif self.inserted:
+            catalog.changed(self.db,
+                            categories = list(self.changed_categories),
+                            products = self.inserted)
+
+    def _error(self, number, error):
+        self.errors.append({"line": number, "error": error})
+
+    def flush(self):
+        """Check, validate and insert batch"""
+
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        batch = self._check_ids(batch)
+        if self.name == 'products':
+            batch = self._check_categories(batch)
+        batch = self._validate(batch)
+        # only parents which passed checks above are used
+        batch = self._resolve_parents(batch)
+
+        inserted = self._insert(batch)
+        for number, doc in inserted:
+            self.ancestors[doc['_id']] = doc['ancestors']
+            self.inserted.append(doc['_id'])
+
+        if self.name == 'products':
+            self._add_to_categories(inserted)
+
+    def _check_ids(self, batch):
+        """Drop rows with existing or repeated ids"""
+
+        existing = set(
+            doc['_id'] for doc in self.collection.find(
+                {'_id': {'$in': [doc['_id'] for number, doc in batch]}},
+                ['_id'])
+        )
+
+        result = []
+        seen = set()
+        for number, doc in batch:
+            if doc['_id'] in existing or doc['_id'] in self.ancestors:
+                self._error(number, u"Document {} already exists".format(
+                    doc['_id']))
+                continue
+            if doc['_id'] in seen:
+                self._error(number, u"Document {} is duplicated".format(
+                    doc['_id']))
+                continue
+            seen.add(doc['_id'])
+            result.append((number, doc))
+
+        return result
+
+    def _check_categories(self, batch):
+        """Drop rows with missing categories"""
+
+        wanted = set()
+        for number, doc in batch:
+            wanted.update(doc.get('categories') or [])
+        existing = set(
+            doc['_id'] for doc in self.db.categories.find(
+                {'_id': {'$in': list(wanted)}}, ['_id'])
+        )
+
+        result = []
+        for number, doc in batch:
+            missing = set(doc.get('categories') or []) - existing
+            if missing:
+                self._error(number, u"Categories not found: {}".format(
+                    u", ".join(unicode(i) for i in missing)))
+                continue
+            result.append((number, doc))
+
+        return result
+
+    def _validate(self, batch):
+        """Validate by model, add default values"""
+
+        document = getattr(self.collection, DOCUMENTS[self.name])
+
+        result = []
+        for number, doc in batch:
+            obj = document()
+            obj.update(doc)
+            try:
+                obj.validate()
+            except (StructureError, SchemaTypeError, AuthorizedTypeError,
+                    RequireFieldError, ValidationError) as e:
+                self._error(number, u"Invalid document: {}".format(e))
+                continue
+            result.append((number, dict(obj)))
+
+        return result
+
+    def _resolve_parents(self, batch):
+        """Set ancestors, drop rows with missing parent"""
+
+        # ancestors of rows of this batch (for their children)
+        ancestors = {}
+        wanted = set(doc['parent'] for number, doc in batch
+                     if doc.get('parent') is not None) - set(self.ancestors)
+        parents = dict(
+            (doc['_id'], doc.get('ancestors') or [])
+            for doc in self.collection.find({'_id': {'$in': list(wanted)}},
+                                            ['ancestors'])
+        )
+
+        result = []
+        for number, doc in batch:
+            parent_id = doc.get('parent')
+            if parent_id is None:
+                doc['ancestors'] = []
+            elif parent_id in ancestors:
+                doc['ancestors'] = ancestors[parent_id] + [parent_id]
+            elif parent_id in self.ancestors:
+                doc['ancestors'] = self.ancestors[parent_id] + [parent_id]
+            elif parent_id in parents:
+                doc['ancestors'] = parents[parent_id] + [parent_id]
+            else:
+                self._error(number, u"Parent {} not found".format(parent_id))
+                continue
+            ancestors[doc['_id']] = doc['ancestors']
+            result.append((number, doc))
+
+        return result
+
+    def _insert(self, batch):
+        """
+        Insert batch by one insert, one by one if it fails
+
+        Children of documents which failed aren't inserted.
+
+        """
+
+        if not batch:
+            return []
+
+        try:
+            self.collection.insert([doc for number, doc in batch])
+            return batch
+        except PyMongoError:
+            pass
+
+        # insert is ordered: it stopped on the failed document
+        ids = [doc['_id'] for number, doc in batch]
+        written = set(
+            doc['_id'] for doc in self.collection.find(
+                {'_id': {'$in': ids}}, ['_id'])
+        )
+
+        result = []
+        failed = set()
+        for number, doc in batch:
+            if doc.get('parent') in failed:
+                self._error(number, u"Parent {} not imported".format(
+                    doc['parent']))
+                failed.add(doc['_id'])
+                continue
+            if doc['_id'] not in written:
+                try:
+                    self.collection.insert(doc)
+                except PyMongoError as e:
+                    self._error(number, u"Not written: {}".format(e))
+                    failed.add(doc['_id'])
+                    continue
+            result.append((number, doc))
+
+        return result
+
+    def _add_to_categories(self, inserted):
+        """Append inserted products to items_order of their categories"""
+
+        products = {}
+        for number, doc in inserted:
+            for category_id in doc.get('categories') or []:
+                products.setdefault(category_id, []).append(doc['_id'])
+
+        for category_id, ids in products.iteritems():
+            self.db.categories.update(
+                {'_id': category_id},
+                {'$addToSet': {'items_order': {'$each': ids}}},
+            )
+            self.changed_categories.add(category_id)
+
+    def _check_items_order(self):
+        """Remove missing products from orders of changed categories"""
+
+        if not self.changed_categories:
+            return
+
+        categories = list(self.db.categories.find(
+            {'_id': {'$in': list(self.changed_categories)}}, ['items_order']))
+        wanted = set()
+        for doc in categories:
+            wanted.update(doc.get('items_order') or [])
+        existing = set(
+            doc['_id'] for doc in self.collection.find(
+                {'_id': {'$in': list(wanted)}}, ['_id'])
+        )
+
+        for doc in categories:
+            missing = set(doc.get('items_order') or []) - existing
+            if missing:
+                self.db.categories.update(
+                    {'_id': doc['_id']},
+                    {'$pull': {'items_order': {'$in': list(missing)}}},
+                )
@@ -0,0 +1,282 @@
+# coding: utf-8
+"""
+Materialized ancestor paths
+
+Products and categories form trees by 'parent' reference. Every node also
+stores 'ancestors' - ids from the root down to its parent - so subtree of
+X is one indexed query: {"ancestors": X}.
+
+Path of the node is kept by models on save (see Product.save,
+Category.save), helpers below fix paths of descendants.
+
+TreeIndex keeps whole tree in memory for navigation (children, subtree,
+path to the root).
+
+"""
+import threading
+
+
+class CycleError(ValueError):
+    """Node can't be moved under itself or its descendant"""
+
+
+def get_ancestors(collection, parent_id):
+    """Ancestors path of a child of parent_id"""
+
+    if parent_id is None:
+        return []
+
+    parent = collection.find_one({'_id': parent_id}, ['ancestors'])
+    if parent is None:
+        return []
+
+    return (parent.get('ancestors') or []) + [parent_id]
+
+def update_path(doc):
+    """
+    Set 'ancestors' of document (mongokit) from its 'parent'
+
+    Returns old path if it's changed and descendants (if any) should be
+    fixed with move_descendants() after document is saved, None otherwise.
+    Raises CycleError if parent is the document or its descendant.
+
+    """
+
+    parent_id = doc.get('parent')
+    old = doc.get('ancestors') or []
+
+    if old[-1:] == ([parent_id] if parent_id is not None else []):
+        doc['ancestors'] = old
+        return None
+
+    new = get_ancestors(doc.collection, parent_id)
+
+    if '_id' not in doc:
+        # new node has no descendants
+        doc['ancestors'] = new
+        return None
+
+    if doc['_id'] == parent_id or doc['_id'] in new:
+        raise CycleError(doc['_id'])
+
+    doc['ancestors'] = new
+    return old
+
+def move(collection, node_id, parent_id):
+    """
+    Move node with its subtree under parent_id (None moves it to top)
+
+    Returns ids of the node and its descendants, None if there is no such
+    node. Raises CycleError if parent is the node or its descendant.
+
+    """
+
+    node = collection.find_one({'_id': node_id}, ['ancestors'])
+    if node is None:
+        return None
+
+    old = node.get('ancestors') or []
+    new = get_ancestors(collection, parent_id)
+    if node_id == parent_id or node_id in new:
+        raise CycleError(node_id)
+
+    collection.update({'_id': node_id},
+        {'$set': {'parent': parent_id, 'ancestors': new}})
+
+    return [node_id] + move_descendants(collection, node_id, old, new)
+
+def move_descendants(collection, node_id, old, new):
+    """
+    Replace old path prefix of node_id descendants with new one
+
+    Returns ids of descendants.
+
+    """
+
+    descendants = descendant_ids(collection, node_id)
+    if not descendants:
+        return []
+
+    spec = {'_id': {'$in': descendants}}
+    if old:
+        collection.update(spec,
+            {'$pullAll': {'ancestors': old}},
+            multi = True)
+    if new:
+        collection.update(spec,
+            {'$push': {'ancestors': {'$each': new, '$position': 0}}},
+            multi = True)
+
+    return descendants
+
+def descendant_ids(collection, node_id):
+    """Ids of all descendants of node"""
+
+    return [doc['_id'] for doc in collection.find({'ancestors': node_id}, ['_id'])]
+
+def remove_node(collection, node_id):
+    """
+    Remove node, its children are moved to its parent
+
+    Returns ids of children or None if there is no such node.
+
+    """
+
+    node = collection.find_one({'_id': node_id}, ['parent'])
+    if node is None:
+        return None
+
+    children = [doc['_id'] for doc in collection.find({'parent': node_id}, ['_id'])]
+
+    collection.update({'parent': node_id},
+        {'$set': {'parent': node.get('parent')}},
+        multi = True)
+    collection.update({'ancestors': node_id},
+        {'$pull': {'ancestors': node_id}},
+        multi = True)
+    collection.remove({'_id': node_id})
+
+    return children
+
+def backfill(collection):
+    """
+    Rebuild 'ancestors' of all nodes from 'parent' references
+
+    Walks the tree from roots level by level. Nodes with missing parent
+    are treated as roots, nodes in cycles are left as is. Only nodes with
+    wrong path are updated, returns their number.
+
+    """
+
+    parents = {}
+    paths = {}
+    for doc in collection.find({}, ['parent', 'ancestors']):
+        parents[doc['_id']] = doc.get('parent')
+        paths[doc['_id']] = doc.get('ancestors')
+
+    children = {}
+    for node_id, parent_id in parents.iteritems():
+        if parent_id not in parents:
+            parent_id = None
+        children.setdefault(parent_id, []).append(node_id)
+
+    count = 0
+    level = [(node_id, []) for node_id in children.get(None, [])]
+    while level:
+        next_level = []
+        for node_id, path in level:
+            if paths[node_id] != path:
+                collection.update({'_id': node_id},
+                                  {'$set': {'ancestors': path}})
+                count += 1
+            for child in children.get(node_id, []):
+                next_level.append((child, path + [node_id]))
+        level = next_level
+
+    return count
+
+
+class Tree(object):
+    """
+    Nodes of one revision with parent -> children adjacency
+
+    Children are ordered by 'order' and 'name'. Nodes with missing parent
+    are roots, nodes in cycles aren't reachable and are skipped.
+
+    """
+
+    def __init__(self, revision, docs):
+        self.revision = revision
+        self.nodes = dict((doc['_id'], doc) for doc in docs)
+
+        self.children = {}
+        for node_id, doc in self.nodes.iteritems():
+            parent_id = doc.get('parent')
+            if parent_id not in self.nodes:
+                parent_id = None
+            self.children.setdefault(parent_id, []).append(node_id)
+        for ids in self.children.itervalues():
+            ids.sort(key = lambda i: (self.nodes[i].get('order') or 0,
+                                      self.nodes[i].get('name'), i))
+
+        self.depth = {}
+        level, depth = self.children.get(None, []), 0
+        while level:
+            next_level = []
+            for node_id in level:
+                self.depth[node_id] = depth
+                next_level.extend(self.children.get(node_id, []))
+            level, depth = next_level, depth + 1
+
+    def __contains__(self, node_id):
+        return node_id in self.depth
+
+    def get_children(self, node_id):
+        """Ordered ids of children (roots for None)"""
+
+        return self.children.get(node_id, [])
+
+    def iter_subtree(self, node_id, max_depth=None, visible=False):
+        """
+        Generate (id, depth relative to node) of node and its descendants
+
+        Depth-first, children in order. Hidden nodes and their subtrees
+        are skipped if visible is True.
+
+        """
+
+        stack = [(node_id, 0)]
+        while stack:
+            node_id, depth = stack.pop()
+            if visible and self.nodes[node_id].get('is_hidden'):
+                continue
+            yield node_id, depth
+            if max_depth is None or depth < max_depth:
+                stack.extend((child, depth + 1) for child in
+                             reversed(self.get_children(node_id)))
+
+    def get_path(self, node_id):
+        """Ids from root to node (inclusive)"""
+
+        path = [node_id]
+        for i in range(self.depth[node_id]):
+            path.append(self.nodes[path[-1]]['parent'])
+        path.reverse()
+
+        return path
+
+
+class TreeIndex(object):
+    """
+    Tree of collection cached in memory of the worker
+
+    Built from one projected scan of collection and rebuilt on first
+    access after catalog revision change (revisions is
+    catalog.RevisionCache).
+
+    """
+
+    def __init__(self, collection, revisions, fields):
+        self.collection = collection
+        self.revisions = revisions
+        self.fields = list(set(fields) | set(['parent', 'order', 'name',
+                                              'is_hidden']))
+        self._lock = threading.Lock()
+        self._tree = None
+
+    def get(self):
+        """Return Tree of current revision"""
+
+        revision = self.revisions.get()[0]
+        current = self._tree
+        if current is not None and current.revision == revision:
+            return current
+
+        with self._lock:
+            current = self._tree
+            if current is None or current.revision != revision:
+                current = Tree(revision,
+                               self.collection.find({}, self.fields))
+                self._tree = current
+
+        return current